@@ -1,101 +1,320 @@
 import argparse
+import glob
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from PIL import Image, ImageEnhance, ImageFilter, ImageOps
 
+BATCH_CHUNK_SIZE = 64  # Images handed to a worker per task
+IN_FLIGHT_PER_WORKER = 2  # Chunks queued per worker, bounds the paths held in memory
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tif', '.tiff', '.webp')
+
+def resize(img, size):
+    return img.resize(size)
+
+def crop(img, crop_box):
+    return img.crop(crop_box)
+
+def brightness(img, factor):
+    return ImageEnhance.Brightness(img).enhance(factor)
+
+def contrast(img, factor):
+    return ImageEnhance.Contrast(img).enhance(factor)
+
+def grayscale(img):
+    return ImageOps.grayscale(img)
+
+def filter_image(img, filter_type):
+    if filter_type == 'blur':
+        return img.filter(ImageFilter.BLUR)
+    elif filter_type == 'sharpen':
+        return img.filter(ImageFilter.SHARPEN)
+    elif filter_type == 'edge':
+        return img.filter(ImageFilter.FIND_EDGES)
+    raise ValueError("Invalid filter type. Choose from 'blur', 'sharpen', 'edge'.")
+
+def resize_cropped(img, size, crop_box):
+    # resize(size) then crop(crop_box) in one step: only the source region under the crop is resampled
+    scale_x, scale_y = img.width / size[0], img.height / size[1]
+    left, top, right, bottom = crop_box
+    return img.resize((right - left, bottom - top), box=(left * scale_x, top * scale_y, right * scale_x, bottom * scale_y))
+
 def resize_image(input_path, output_path, size):
     with Image.open(input_path) as img:
-        img = img.resize(size)
+        img = resize(img, size)
         img.save(output_path)
 
 def crop_image(input_path, output_path, crop_box):
     with Image.open(input_path) as img:
-        img = img.crop(crop_box)
+        img = crop(img, crop_box)
         img.save(output_path)
 
 def adjust_brightness(input_path, output_path, factor):
     with Image.open(input_path) as img:
-        enhancer = ImageEnhance.Brightness(img)
-        img = enhancer.enhance(factor)
+        img = brightness(img, factor)
         img.save(output_path)
 
 def adjust_contrast(input_path, output_path, factor):
     with Image.open(input_path) as img:
-        enhancer = ImageEnhance.Contrast(img)
-        img = enhancer.enhance(factor)
+        img = contrast(img, factor)
         img.save(output_path)
 
 def convert_to_grayscale(input_path, output_path):
     with Image.open(input_path) as img:
-        img = ImageOps.grayscale(img)
+        img = grayscale(img)
         img.save(output_path)
 
 def apply_filter(input_path, output_path, filter_type):
     with Image.open(input_path) as img:
-        if filter_type == 'blur':
-            img = img.filter(ImageFilter.BLUR)
-        elif filter_type == 'sharpen':
-            img = img.filter(ImageFilter.SHARPEN)
-        elif filter_type == 'edge':
-            img = img.filter(ImageFilter.FIND_EDGES)
-        else:
-            raise ValueError("Invalid filter type. Choose from 'blur', 'sharpen', 'edge'.")
+        img = filter_image(img, filter_type)
         img.save(output_path)
 
 def convert_format(input_path, output_path, format):
     with Image.open(input_path) as img:
         img.save(output_path, format=format)
 
-def main():
-    parser = argparse.ArgumentParser(description="Image processing toolkit")
-    parser.add_argument('action', choices=['resize', 'crop', 'brightness', 'contrast', 'grayscale', 'filter', 'convert'], help="Action to perform on the image")
-    parser.add_argument('input', help="Path to the input image file")
-    parser.add_argument('output', help="Path to the output image file")
-    parser.add_argument('--size', nargs=2, type=int, help="Size for resizing (width height)")
-    parser.add_argument('--crop', nargs=4, type=int, help="Crop box (left top right bottom)")
-    parser.add_argument('--brightness', type=float, help="Brightness factor (e.g., 1.5 for 50% brighter)")
-    parser.add_argument('--contrast', type=float, help="Contrast factor (e.g., 1.5 for 50% more contrast)")
-    parser.add_argument('--filter', choices=['blur', 'sharpen', 'edge'], help="Filter type to apply")
-    parser.add_argument('--format', help="Format to convert the image to (e.g., PNG, JPEG)")
+# Pipeline steps: name -> (in-memory operation, argument parser)
+OPERATIONS = {
+    'resize': (resize, lambda values: (tuple(int(v) for v in values),)),
+    'crop': (crop, lambda values: (tuple(int(v) for v in values),)),
+    'brightness': (brightness, lambda values: (float(values[0]),)),
+    'contrast': (contrast, lambda values: (float(values[0]),)),
+    'grayscale': (grayscale, lambda values: ()),
+    'filter': (filter_image, lambda values: (values[0],)),
+    'resize_cropped': (resize_cropped, None),
+}
+POINTWISE_OPERATIONS = ('brightness', 'grayscale')  # Per-pixel, so they commute with crop; contrast uses the whole image's mean
 
-    args = parser.parse_args()
+def parse_step(name, values):
+    if name not in OPERATIONS or OPERATIONS[name][1] is None:
+        raise ValueError(f"Invalid pipeline step '{name}'. Choose from {', '.join(n for n, (_, p) in OPERATIONS.items() if p)}.")
+    if not isinstance(values, (list, tuple)):
+        values = [] if values is None else [values]
+    return name, OPERATIONS[name][1](values)
+
+def parse_pipeline(specs):
+    # CLI steps look like crop:0,0,800,600 resize:400,300 filter:sharpen grayscale
+    steps = []
+    for spec in specs:
+        name, _, values = spec.partition(':')
+        steps.append(parse_step(name, values.split(',') if values else []))
+    return steps
 
+def load_recipe(recipe_file):
+    # A JSON or YAML recipe: a list of {step: args} mappings, or {"steps": [...], "format": "JPEG"}
+    with open(recipe_file) as file:
+        if recipe_file.lower().endswith(('.yaml', '.yml')):
+            import yaml
+            recipe = yaml.safe_load(file)
+        else:
+            import json
+            recipe = json.load(file)
+    if isinstance(recipe, list):
+        recipe = {'steps': recipe}
+    steps = [parse_step(name, values) for step in recipe['steps'] for name, values in step.items()]
+    return steps, recipe.get('format')
+
+def optimize_pipeline(steps):
+    # Move each crop ahead of per-pixel steps; a crop that then meets a resize inside its bounds is fused with it
+    optimized = []
+    for name, params in steps:
+        if name == 'crop':
+            position = len(optimized)
+            while position and optimized[position - 1][0] in POINTWISE_OPERATIONS:
+                position -= 1
+            if position and optimized[position - 1][0] == 'resize':
+                (width, height), (left, top, right, bottom) = optimized[position - 1][1][0], params[0]
+                if 0 <= left < right <= width and 0 <= top < bottom <= height:
+                    optimized[position - 1] = ('resize_cropped', (optimized[position - 1][1][0], params[0]))
+                    continue
+            optimized.insert(position, (name, params))
+        else:
+            optimized.append((name, params))
+    return optimized
+
+def run_pipeline(input_path, output_path, steps, format=None):
+    # One decode, every step on the in-memory image, one encode
+    with Image.open(input_path) as img:
+        for name, params in steps:
+            img = OPERATIONS[name][0](img, *params)
+        if (format or '').upper() in ('JPEG', 'JPG') and img.mode not in ('RGB', 'L', 'CMYK'):
+            img = img.convert('RGB')
+        img.save(output_path, format=format)
+
+def manifest_paths(manifest_file):
+    with open(manifest_file) as manifest:
+        for line in manifest:
+            path = line.strip()
+            if path and not path.startswith('#'):
+                yield path
+
+def glob_root(pattern):
+    # The leading directories of a glob pattern that contain no wildcard
+    parts = []
+    for part in os.path.dirname(pattern).split(os.sep):
+        if glob.has_magic(part):
+            break
+        parts.append(part)
+    return os.sep.join(parts) or '.'
+
+def iter_batch_inputs(source):
+    # A directory is walked, an existing file is a manifest with one path per line, anything else is a glob;
+    # output paths keep the layout below the common root so equal file names in different folders do not collide
+    if os.path.isdir(source):
+        for root, _, files in os.walk(source):
+            for name in sorted(files):
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    yield os.path.join(root, name), os.path.relpath(os.path.join(root, name), source)
+    elif os.path.isfile(source):
+        # First pass finds the common directory, second pass streams the paths relative to it
+        common_root = None
+        for path in manifest_paths(source):
+            directory = os.path.dirname(os.path.abspath(path))
+            common_root = directory if common_root is None else os.path.commonpath([common_root, directory])
+        for path in manifest_paths(source):
+            yield path, os.path.relpath(os.path.abspath(path), common_root)
+    else:
+        root = glob_root(source)
+        for path in glob.iglob(source, recursive=True):
+            if os.path.isfile(path):
+                yield path, os.path.relpath(path, root)
+
+def batch_output_path(output_dir, relative_path, format=None):
+    output_path = os.path.join(output_dir, relative_path)
+    if format:
+        output_path = os.path.splitext(output_path)[0] + '.' + format.lower()
+    return output_path
+
+def process_chunk(operation, params, pairs):
+    # Runs in a worker process; failures are returned per image instead of aborting the chunk
+    failures = []
+    for input_path, output_path in pairs:
+        try:
+            os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+            operation(input_path, output_path, *params)
+        except Exception as e:
+            failures.append((input_path, str(e)))
+    return len(pairs), failures
+
+def run_batch(source, output_dir, operation, params, format=None, workers=None, chunk_size=BATCH_CHUNK_SIZE):
+    workers = workers or os.cpu_count() or 1
+    started = time.perf_counter()
+    processed = 0
+    failures = []
+    outputs = set()
+    in_flight = set()
+    chunk = []
+
+    def collect(done):
+        nonlocal processed
+        for future in done:
+            count, chunk_failures = future.result()
+            processed += count
+            failures.extend(chunk_failures)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for input_path, relative_path in iter_batch_inputs(source):
+            output_path = batch_output_path(output_dir, relative_path, format)
+            if output_path in outputs:
+                processed += 1
+                failures.append((input_path, f"output {output_path} is already written by another input"))
+                continue
+            outputs.add(output_path)
+            chunk.append((input_path, output_path))
+            if len(chunk) < chunk_size:
+                continue
+            if len(in_flight) >= workers * IN_FLIGHT_PER_WORKER:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+            in_flight.add(executor.submit(process_chunk, operation, params, chunk))
+            chunk = []
+        if chunk:
+            in_flight.add(executor.submit(process_chunk, operation, params, chunk))
+        collect(wait(in_flight).done)
+
+    elapsed = time.perf_counter() - started
+    for input_path, error in failures:
+        print(f"Failed to process {input_path}: {error}")
+    print(f"Processed {processed - len(failures)}/{processed} images with {workers} workers in {elapsed:.2f}s "
+          f"({processed / elapsed if elapsed else 0:.1f} images/s), {len(failures)} failures")
+    return processed, failures
+
+def select_operation(args):
+    # Returns the operation and its extra arguments, or None when a required option is missing
     if args.action == 'resize':
         if not args.size:
             print("Size is required for resizing")
-            return
-        resize_image(args.input, args.output, tuple(args.size))
+            return None
+        return resize_image, (tuple(args.size),)
 
     elif args.action == 'crop':
         if not args.crop:
             print("Crop box is required for cropping")
-            return
-        crop_image(args.input, args.output, tuple(args.crop))
+            return None
+        return crop_image, (tuple(args.crop),)
 
     elif args.action == 'brightness':
         if args.brightness is None:
             print("Brightness factor is required")
-            return
-        adjust_brightness(args.input, args.output, args.brightness)
+            return None
+        return adjust_brightness, (args.brightness,)
 
     elif args.action == 'contrast':
         if args.contrast is None:
             print("Contrast factor is required")
-            return
-        adjust_contrast(args.input, args.output, args.contrast)
+            return None
+        return adjust_contrast, (args.contrast,)
 
     elif args.action == 'grayscale':
-        convert_to_grayscale(args.input, args.output)
+        return convert_to_grayscale, ()
 
     elif args.action == 'filter':
         if not args.filter:
             print("Filter type is required")
-            return
-        apply_filter(args.input, args.output, args.filter)
+            return None
+        return apply_filter, (args.filter,)
 
     elif args.action == 'convert':
         if not args.format:
             print("Format is required for conversion")
-            return
-        convert_format(args.input, args.output, args.format)
+            return None
+        return convert_format, (args.format,)
+
+    elif args.action == 'pipeline':
+        if not args.pipeline and not args.recipe:
+            print("Pipeline steps or a recipe file are required")
+            return None
+        steps, format = load_recipe(args.recipe) if args.recipe else (parse_pipeline(args.pipeline), None)
+        return run_pipeline, (optimize_pipeline(steps), args.format or format)
+
+def main():
+    parser = argparse.ArgumentParser(description="Image processing toolkit")
+    parser.add_argument('action', choices=['resize', 'crop', 'brightness', 'contrast', 'grayscale', 'filter', 'convert', 'pipeline'], help="Action to perform on the image")
+    parser.add_argument('input', help="Path to the input image file (with --batch: a directory, glob or manifest file)")
+    parser.add_argument('output', help="Path to the output image file (with --batch: the output directory)")
+    parser.add_argument('--size', nargs=2, type=int, help="Size for resizing (width height)")
+    parser.add_argument('--crop', nargs=4, type=int, help="Crop box (left top right bottom)")
+    parser.add_argument('--brightness', type=float, help="Brightness factor (e.g., 1.5 for 50% brighter)")
+    parser.add_argument('--contrast', type=float, help="Contrast factor (e.g., 1.5 for 50% more contrast)")
+    parser.add_argument('--filter', choices=['blur', 'sharpen', 'edge'], help="Filter type to apply")
+    parser.add_argument('--format', help="Format to convert the image to (e.g., PNG, JPEG)")
+    parser.add_argument('--pipeline', nargs='+', metavar='STEP', help="Pipeline steps, e.g. crop:0,0,800,600 resize:400,300 filter:sharpen")
+    parser.add_argument('--recipe', help="JSON or YAML recipe file with the pipeline steps")
+    parser.add_argument('--batch', action='store_true', help="Process every image of a directory, glob or manifest file")
+    parser.add_argument('--workers', type=int, help="Worker processes in batch mode (defaults to the number of cores)")
+
+    args = parser.parse_args()
+
+    selected = select_operation(args)
+    if selected is None:
+        return
+    operation, params = selected
+
+    if args.batch:
+        output_format = args.format if args.action == 'convert' else params[1] if args.action == 'pipeline' else None
+        run_batch(args.input, args.output, operation, params, output_format, args.workers)
+    else:
+        operation(args.input, args.output, *params)
 
 if __name__ == '__main__':
     main()
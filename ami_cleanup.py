@@ -2,9 +2,13 @@
 # Date: 10/07/24
 # Description: This script should automate deletion of old, unused AMIs based on age or custom tags.
 
+import argparse
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 import logging
 
 # Setup logging
@@ -14,29 +18,127 @@ logging.basicConfig(level=logging.INFO)
 AMI_RETENTION_PERIOD = 30
 CUSTOM_TAG_KEY = "Delete"
 CUSTOM_TAG_VALUE = "True"
+MAX_WORKERS = 16  # Concurrent deregistrations / snapshot deletes
 
-# Initialize clients
-ec2_client = boto3.client('ec2')
+CLIENT_CONFIG = Config(max_pool_connections=MAX_WORKERS, retries={'mode': 'adaptive', 'max_attempts': 10})
 
-def delete_ami(ami_id):
+# Initialize clients, the connection pool sized for the workers and retries backing off on throttling
+ec2_client = boto3.client('ec2', config=CLIENT_CONFIG)
+autoscaling_client = boto3.client('autoscaling', config=CLIENT_CONFIG)
+
+@lru_cache(maxsize=None)
+def regional_clients(region):
+    if region is None:
+        return ec2_client, autoscaling_client
+    return boto3.client('ec2', region_name=region, config=CLIENT_CONFIG), boto3.client('autoscaling', region_name=region, config=CLIENT_CONFIG)
+
+def list_owned_images(client=ec2_client):
+    paginator = client.get_paginator('describe_images')
+    return [image for page in paginator.paginate(Owners=['self']) for image in page['Images']]
+
+def image_snapshot_ids(image):
+    return [mapping['Ebs']['SnapshotId'] for mapping in image.get('BlockDeviceMappings', [])
+            if mapping.get('Ebs', {}).get('SnapshotId')]
+
+def build_snapshot_index(images, client=ec2_client):
+    # One paginated pass over owned snapshots and volumes: snapshot id -> referencing AMIs and volumes
+    index = {}
+    for page in client.get_paginator('describe_snapshots').paginate(OwnerIds=['self']):
+        for snapshot in page['Snapshots']:
+            index[snapshot['SnapshotId']] = {'amis': set(), 'volumes': set()}
+    for image in images:
+        for snapshot_id in image_snapshot_ids(image):
+            if snapshot_id in index:
+                index[snapshot_id]['amis'].add(image['ImageId'])
+    for page in client.get_paginator('describe_volumes').paginate():
+        for volume in page['Volumes']:
+            if volume.get('SnapshotId') in index:
+                index[volume['SnapshotId']]['volumes'].add(volume['VolumeId'])
+    return index
+
+def instance_image_ids(client):
+    image_ids = set()
+    for page in client.get_paginator('describe_instances').paginate(
+            Filters=[{'Name': 'instance-state-name', 'Values': ['pending', 'running', 'stopping', 'stopped']}]):
+        for reservation in page['Reservations']:
+            image_ids.update(instance['ImageId'] for instance in reservation['Instances'])
+    return image_ids
+
+def launch_template_image_ids(client):
+    # Every version counts: Auto Scaling groups and fleets may pin an older version than $Default
+    image_ids = set()
+    for page in client.get_paginator('describe_launch_templates').paginate():
+        for template in page['LaunchTemplates']:
+            for versions in client.get_paginator('describe_launch_template_versions').paginate(LaunchTemplateId=template['LaunchTemplateId']):
+                image_ids.update(version['LaunchTemplateData'].get('ImageId') for version in versions['LaunchTemplateVersions'])
+    image_ids.discard(None)
+    return image_ids
+
+def launch_configuration_image_ids(client):
+    paginator = client.get_paginator('describe_launch_configurations')
+    return {config['ImageId'] for page in paginator.paginate() for config in page['LaunchConfigurations']}
+
+def build_reference_set(regions, max_workers=MAX_WORKERS):
+    # Every ImageId still referenced by instances, launch templates or launch configurations, sources and regions in parallel
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = []
+        for region in regions:
+            ec2, autoscaling = regional_clients(region)
+            futures.append(executor.submit(instance_image_ids, ec2))
+            futures.append(executor.submit(launch_template_image_ids, ec2))
+            futures.append(executor.submit(launch_configuration_image_ids, autoscaling))
+        return set().union(*(future.result() for future in futures))
+
+def deregister_ami(ami_id, client=ec2_client):
     try:
-        ec2_client.deregister_image(ImageId=ami_id)
+        client.deregister_image(ImageId=ami_id)
         logging.info(f"Successfully De-registered AMI: {ami_id}")
-
-        snapshots = ec2_client.describe_snapshots(Filters=[{'Name': 'description', 'Values': [f'*{ami_id}*']}])
-        for snapshot in snapshots['Snapshots']:
-            try:
-                ec2_client.delete_snapshot(SnapshotId=snapshot['SnapshotId'])
-                logging.info(f"Successfully Deleted Snapshot: {snapshot['SnapshotId']}")
-            except Exception as e:
-                logging.error(f"Failed to delete Snapshot {snapshot['SnapshotId']} due to error: {e}")
+        return True
     except ClientError as e:
         logging.error(f"Failed to delete AMI {ami_id} due to error: {e}")
+        return False
 
-def ami_verification(ami):
+def delete_snapshot(snapshot_id, client=ec2_client):
     try:
-        creation_date = datetime.strptime(ami['CreationDate'], '%Y-%m-%dT%H:%M:%S.%fZ')
-        if creation_date < datetime.utcnow() - timedelta(days=AMI_RETENTION_PERIOD):
+        client.delete_snapshot(SnapshotId=snapshot_id)
+        logging.info(f"Successfully Deleted Snapshot: {snapshot_id}")
+        return True
+    except Exception as e:
+        logging.error(f"Failed to delete Snapshot {snapshot_id} due to error: {e}")
+        return False
+
+def delete_amis(images, snapshot_index, max_workers=MAX_WORKERS, client=ec2_client):
+    # Deregister concurrently, then delete the owned snapshots no longer referenced by a remaining AMI
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(lambda image: deregister_ami(image['ImageId'], client), images)
+        deregistered = {image['ImageId'] for image, ok in zip(images, results) if ok}
+
+        snapshot_ids = []
+        for image in images:
+            if image['ImageId'] not in deregistered:
+                continue
+            for snapshot_id in image_snapshot_ids(image):
+                references = snapshot_index.get(snapshot_id)
+                if references is None or not references['amis'] <= deregistered:
+                    continue
+                if references['volumes']:
+                    logging.info(f"Snapshot {snapshot_id} is the source of volumes {sorted(references['volumes'])}")
+                snapshot_ids.append(snapshot_id)
+        snapshot_ids = list(dict.fromkeys(snapshot_ids))
+        deleted = sum(executor.map(lambda snapshot_id: delete_snapshot(snapshot_id, client), snapshot_ids))
+    return len(deregistered), deleted
+
+def parse_creation_date(value):
+    # CreationDate is ISO 8601 in UTC, with or without fractional seconds
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+def ami_verification(ami, cutoff_date=None, referenced=frozenset()):
+    try:
+        if ami['ImageId'] in referenced:
+            logging.info(f"AMI {ami['ImageId']} is still referenced by an instance, launch template or launch configuration")
+            return False
+        cutoff_date = cutoff_date or datetime.now(timezone.utc) - timedelta(days=AMI_RETENTION_PERIOD)
+        if parse_creation_date(ami['CreationDate']) < cutoff_date:
             logging.info(f"AMI {ami['ImageId']} is older than {AMI_RETENTION_PERIOD} days")
             return True
         if 'Tags' in ami:
@@ -49,15 +151,31 @@ def ami_verification(ami):
     except Exception as e:
         logging.error(f"Failed to verify AMI {ami['ImageId']} due to error: {e}")
 
+def clean_region(region, referenced):
+    client = regional_clients(region)[0]
+    cutoff_date = datetime.now(timezone.utc) - timedelta(days=AMI_RETENTION_PERIOD)
+    images = list_owned_images(client)
+    candidates = []
+    for image in images:
+        if ami_verification(image, cutoff_date, referenced):
+            logging.info(f"AMI {image['ImageId']} is marked for deletion")
+            candidates.append(image)
+        else:
+            logging.info(f"AMI {image['ImageId']} is retained")
+    if not candidates:
+        return
+    snapshot_index = build_snapshot_index(images, client)
+    deregistered, deleted = delete_amis(candidates, snapshot_index, client=client)
+    logging.info(f"{region or 'default region'}: De-registered {deregistered}/{len(candidates)} AMIs and deleted {deleted} snapshots")
+
 def main():
+    parser = argparse.ArgumentParser(description="Delete old or tagged AMIs that nothing references any more")
+    parser.add_argument('--regions', nargs='+', default=[None], help="Regions to clean (defaults to the configured region)")
+    args = parser.parse_args()
     try:
-        images = ec2_client.describe_images(Owners=['self'])
-        for image in images['Images']:
-            if ami_verification(image):
-                logging.info(f"AMI {image['ImageId']} is marked for deletion")
-                delete_ami(image['ImageId'])
-            else:
-                logging.info(f"AMI {image['ImageId']} is retained")
+        referenced = build_reference_set(args.regions)
+        for region in args.regions:
+            clean_region(region, referenced)
     except ClientError as e:
         logging.error(f"API Error occurred: {e}")
     except Exception as e:
@@ -2,9 +2,19 @@
 # date: 10/07/2024
 # description: This script should analyze versioned buckets to identify potential storage cost optimizations (e.g., deleting old versions, transitioning to Intelligent Tiering).
 
+import argparse
 import boto3
+import hashlib
+import json
+import os
+import threading
+import time
+from botocore.config import Config
 from botocore.exceptions import ClientError 
-from datetime import datetime, timedelta
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 
 # Initialize clients
 s3_client = boto3.client('s3')
@@ -12,6 +22,31 @@ s3_client = boto3.client('s3')
 # Define constants
 VERSION_RETENTION_DAYS = 30  # Number of days to retain old versions
 TRANSITION_DAYS = 60  # Number of days before transitioning to intelligent tier 
+MAX_WORKERS = 32  # Number of buckets analyzed concurrently
+GB = 1024 ** 3
+REPORT_FILE = 'version_report.json'
+JOURNAL_FILE = 'version_delete_journal.jsonl'
+DELETE_BATCH_SIZE = 1000  # delete_objects accepts at most 1000 keys
+DELETE_WORKERS = 8  # Concurrent delete_objects calls per bucket
+DELETE_RATE = 3000  # Deleted keys per second per bucket; S3 allows 3500 DELETEs/s per prefix
+MIN_DELETE_RATE = 100
+MAX_RETRIES = 8
+LIFECYCLE_COVERAGE = 0.9  # Share of the estimated savings the synthesized lifecycle rules must cover
+MAX_PREFIX_RULES = 10  # Beyond this many prefix rules a single bucket-wide rule is planned instead
+RULE_ID_PREFIX = 'cost-optimizer-'
+MAX_RULE_ID_LENGTH = 255  # S3 rejects lifecycle rule IDs longer than this
+
+# Storage price per GB-month by storage class (us-east-1); override with --prices
+PRICE_TABLE = {
+    'STANDARD': 0.023,
+    'STANDARD_IA': 0.0125,
+    'ONEZONE_IA': 0.01,
+    'INTELLIGENT_TIERING': 0.023,
+    'INTELLIGENT_TIERING_IA': 0.0125,
+    'GLACIER_IR': 0.004,
+    'GLACIER': 0.0036,
+    'DEEP_ARCHIVE': 0.00099,
+}
 
 # Function to list all the buckets
 def list_buckets():
@@ -21,35 +56,457 @@ def list_buckets():
     except ClientError as e:
         print(f"API Error occurred: {e}")
 
+# Function to find the region of a bucket (cached, LocationConstraint is None for us-east-1)
+@lru_cache(maxsize=None)
+def get_bucket_region(bucket_name):
+    location = s3_client.get_bucket_location(Bucket=bucket_name)['LocationConstraint']
+    if location == 'EU':
+        return 'eu-west-1'
+    return location or 'us-east-1'
+
+# Function to get the shared client of a region, its connection pool sized for the workers
+@lru_cache(maxsize=None)
+def get_regional_client(region):
+    return boto3.client('s3', region_name=region, config=Config(max_pool_connections=MAX_WORKERS))
+
+# Function to stream every version and delete marker of a bucket, following the KeyMarker/VersionIdMarker pages
+def iter_versions(bucket_name, client, key_marker=None, version_id_marker=None, on_page=None):
+    # Within a page each key's entries come newest first; merging the two lists restores that order
+    params = {'Bucket': bucket_name}
+    if key_marker:
+        params['KeyMarker'] = key_marker
+        params['VersionIdMarker'] = version_id_marker
+    paginator = client.get_paginator('list_object_versions')
+    for page in paginator.paginate(**params):
+        entries = page.get('Versions', []) + page.get('DeleteMarkers', [])
+        entries.sort(key=lambda entry: (entry['Key'], -entry['LastModified'].timestamp()))
+        for entry in entries:
+            yield entry
+        if on_page and page.get('IsTruncated'):
+            on_page(page['NextKeyMarker'], page.get('NextVersionIdMarker'))
+
+# Token bucket limiting deleted keys per second, halving its rate on SlowDown and recovering on success
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = max(capacity or rate, DELETE_BATCH_SIZE)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, tokens=1):
+        with self.lock:
+            self._refill()
+            if self.tokens < tokens:
+                time.sleep((tokens - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= tokens
+
+    def slow_down(self):
+        with self.lock:
+            self.rate = max(self.rate / 2, MIN_DELETE_RATE)
+
+    def speed_up(self):
+        with self.lock:
+            self.rate = min(self.rate + self.max_rate * 0.05, self.max_rate)
+
+# Append-only journal of deletion progress, so an interrupted purge resumes listing where it stopped
+class DeletionJournal:
+    def __init__(self, journal_file):
+        self.journal_file = journal_file
+        self.markers = {}
+        if os.path.exists(journal_file):
+            with open(journal_file) as file:
+                for line in file:
+                    record = json.loads(line)
+                    if 'key_marker' in record:
+                        self.markers[record['bucket']] = (record['key_marker'], record['version_id_marker'])
+                    elif record.get('complete'):
+                        self.markers.pop(record['bucket'], None)
+        self.file = open(journal_file, mode='a')
+        self.lock = threading.Lock()
+
+    def record(self, record):
+        with self.lock:
+            self.file.write(json.dumps(record) + '\n')
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+# Batched deleter of selected versions for one bucket
+class VersionDeleter:
+    def __init__(self, bucket_name, client, journal=None, dry_run=False, rate=DELETE_RATE, workers=DELETE_WORKERS):
+        self.bucket_name = bucket_name
+        self.client = client
+        self.journal = journal
+        self.dry_run = dry_run
+        self.limiter = TokenBucket(rate)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.in_flight = threading.BoundedSemaphore(2 * workers)  # add() blocks once this many batches are queued
+        self.buffer = []
+        self.submitted = 0
+        self.completed = set()
+        self.done_upto = 0  # All batches with ids up to this one have finished
+        self.pending_markers = deque()
+        self.deleted = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+
+    def resume_marker(self):
+        if self.journal:
+            return self.journal.markers.get(self.bucket_name, (None, None))
+        return None, None
+
+    def add(self, key, version_id):
+        self.buffer.append({'Key': key, 'VersionId': version_id})
+        if len(self.buffer) >= DELETE_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.in_flight.acquire()
+            self.submitted += 1
+            self.executor.submit(self._delete_batch, self.submitted, self.buffer)
+            self.buffer = []
+
+    def mark_page(self, key_marker, version_id_marker):
+        # The listing may resume after this page once every batch holding its versions has finished
+        if self.journal:
+            with self.lock:
+                self.pending_markers.append((self.submitted + (1 if self.buffer else 0), key_marker, version_id_marker))
+                self._advance()
+
+    def _advance(self):
+        while self.done_upto + 1 in self.completed:
+            self.done_upto += 1
+            self.completed.remove(self.done_upto)
+        latest = None
+        while self.pending_markers and self.pending_markers[0][0] <= self.done_upto:
+            latest = self.pending_markers.popleft()
+        if latest:
+            self.journal.record({'bucket': self.bucket_name, 'key_marker': latest[1], 'version_id_marker': latest[2]})
+
+    def _delete_batch(self, batch_id, objects):
+        try:
+            if self.dry_run:
+                print(f"Dry run: would delete {len(objects)} versions from bucket {self.bucket_name}")
+                with self.lock:
+                    self.deleted += len(objects)
+                return
+            for attempt in range(MAX_RETRIES + 1):
+                self.limiter.acquire(len(objects))
+                try:
+                    response = self.client.delete_objects(Bucket=self.bucket_name, Delete={'Objects': objects, 'Quiet': True})
+                except ClientError as e:
+                    if e.response['Error']['Code'] in ('SlowDown', 'ServiceUnavailable', '503') and attempt < MAX_RETRIES:
+                        self.limiter.slow_down()
+                        time.sleep(min(2 ** attempt * 0.1, 10))
+                        continue
+                    print(f"API Error occurred: {e}")
+                    with self.lock:
+                        self.failed += len(objects)
+                    return
+
+                errors = response.get('Errors', [])
+                throttled = [{'Key': error['Key'], 'VersionId': error['VersionId']} for error in errors if error['Code'] == 'SlowDown']
+                failures = [error for error in errors if error['Code'] != 'SlowDown']
+                with self.lock:
+                    self.deleted += len(objects) - len(errors)
+                    self.failed += len(failures)
+                if failures and self.journal:
+                    self.journal.record({'bucket': self.bucket_name, 'errors': failures})
+                if not throttled:
+                    self.limiter.speed_up()
+                    return
+                self.limiter.slow_down()
+                time.sleep(min(2 ** attempt * 0.1, 10))
+                objects = throttled
+            with self.lock:
+                self.failed += len(objects)
+        finally:
+            with self.lock:
+                self.completed.add(batch_id)
+                if self.journal:
+                    self._advance()
+            self.in_flight.release()
+
+    def close(self, complete=True):
+        self.flush()
+        self.executor.shutdown(wait=True)
+        if self.journal and complete:
+            self.journal.record({'bucket': self.bucket_name, 'complete': True, 'deleted': self.deleted, 'failed': self.failed})
+
+# Function to create an empty set of version aggregates
+def new_totals():
+    return {
+        'versions': 0, 'bytes': 0,
+        'noncurrent_versions': 0, 'noncurrent_bytes': 0,
+        'expired_noncurrent_versions': 0, 'expired_noncurrent_bytes': 0,
+        'transition_candidates': 0, 'transition_bytes': 0,
+        'delete_markers': 0, 'expiration_savings': 0.0, 'transition_savings': 0.0,
+        'estimated_monthly_savings': 0.0,
+    }
+
+# Function to add one version to a set of aggregates
+def add_version(totals, size, expired, transition, savings):
+    totals['versions'] += 1
+    totals['bytes'] += size
+    if expired is not None:
+        totals['noncurrent_versions'] += 1
+        totals['noncurrent_bytes'] += size
+        if expired:
+            totals['expired_noncurrent_versions'] += 1
+            totals['expired_noncurrent_bytes'] += size
+    if transition:
+        totals['transition_candidates'] += 1
+        totals['transition_bytes'] += size
+        totals['transition_savings'] += savings
+    elif expired:
+        totals['expiration_savings'] += savings
+    totals['estimated_monthly_savings'] += savings
+
 # Bucket analyzer function
-def bucket_analyzer(bucket_name):
+def bucket_analyzer(bucket_name, client=None, prices=PRICE_TABLE, details=False, deleter=None):
     try:
-        response = s3_client.list_object_versions(Bucket=bucket_name)
-        versions = response.get('Versions', [])
-        for version in versions:
+        client = client or get_regional_client(get_bucket_region(bucket_name))
+        now = datetime.now(timezone.utc)
+        retention_cutoff = now - timedelta(days=VERSION_RETENTION_DAYS)
+        transition_cutoff = now - timedelta(days=TRANSITION_DAYS)
+        tiering_saving = prices['STANDARD'] - prices['INTELLIGENT_TIERING_IA']
+        totals = new_totals()
+        prefixes = defaultdict(new_totals)
+        previous_key = None
+        newer_modified = None
+        key_marker, version_id_marker = deleter.resume_marker() if deleter else (None, None)
+        on_page = deleter.mark_page if deleter else None
+        for version in iter_versions(bucket_name, client, key_marker, version_id_marker, on_page):
             last_modified = version['LastModified']
-            version_id = version['VersionId']
             key = version['Key']
-            size = version['Size']
+            if key != previous_key:
+                previous_key = key
+                newer_modified = None
+            # A version becomes noncurrent when the next newer version or delete marker is written
+            noncurrent_since = newer_modified
+            newer_modified = last_modified
+            prefix = key.split('/')[0] + '/' if '/' in key else ''  # Root-level keys share the '' aggregate
 
-            if last_modified < datetime.now(tz=last_modified.tzinfo) - timedelta(days=VERSION_RETENTION_DAYS):
-                print(f"Deleting version {version_id} of {key} in bucket {bucket_name}, last modified: {last_modified}")
+            if 'Size' not in version:  # Delete marker
+                totals['delete_markers'] += 1
+                prefixes[prefix]['delete_markers'] += 1
+                continue
 
-            if last_modified < datetime.now(tz=last_modified.tzinfo) - timedelta(days=TRANSITION_DAYS):
-                print(f"Consider transitioning {key} (Version ID: {version_id}) to intelligent tier, last modified: {last_modified}")
+            size = version['Size']
+            storage_class = version.get('StorageClass', 'STANDARD')
+            expired = None if noncurrent_since is None else noncurrent_since < retention_cutoff
+            transition = noncurrent_since is None and storage_class == 'STANDARD' and last_modified < transition_cutoff
+            savings = 0.0
+            if expired:
+                savings = size / GB * prices.get(storage_class, prices['STANDARD'])
+                if deleter:
+                    deleter.add(key, version['VersionId'])
+                if details:
+                    print(f"Deleting version {version['VersionId']} of {key} in bucket {bucket_name}, noncurrent since: {noncurrent_since}")
+            elif transition:
+                savings = size / GB * tiering_saving
+                if details:
+                    print(f"Consider transitioning {key} (Version ID: {version['VersionId']}) to intelligent tier, last modified: {last_modified}")
+            add_version(totals, size, expired, transition, savings)
+            add_version(prefixes[prefix], size, expired, transition, savings)
 
+        return {'bucket': bucket_name, 'totals': totals, 'prefixes': dict(prefixes)}
     except ClientError as e:
         print(f"API Error occurred: {e}")
     except Exception as e:
         print(f"Exception occurred: {e}")
 
+# Function to analyze a bucket and delete its expired noncurrent versions in batches
+def purge_bucket(bucket_name, client, prices, details, journal=None, dry_run=False):
+    deleter = VersionDeleter(bucket_name, client, journal, dry_run)
+    report = bucket_analyzer(bucket_name, client, prices, details, deleter)
+    deleter.close(complete=report is not None and not dry_run)
+    if report:
+        report['deleted_versions'] = deleter.deleted
+        report['failed_deletions'] = deleter.failed
+    return report
+
+# Function to name the rule of a prefix; long prefixes are truncated and suffixed with a hash to stay unique
+def lifecycle_rule_id(prefix):
+    rule_id = RULE_ID_PREFIX + (prefix or 'bucket')
+    if len(rule_id) <= MAX_RULE_ID_LENGTH:
+        return rule_id
+    digest = hashlib.sha1(prefix.encode('utf-8')).hexdigest()[:16]
+    return rule_id[:MAX_RULE_ID_LENGTH - len(digest) - 1] + '-' + digest
+
+# Function to build the lifecycle rule for a prefix ('' for the whole bucket) from its aggregates
+def lifecycle_rule(prefix, totals):
+    rule = {
+        'ID': lifecycle_rule_id(prefix),
+        'Filter': {'Prefix': prefix},
+        'Status': 'Enabled',
+    }
+    if totals['expiration_savings'] > 0:
+        rule['NoncurrentVersionExpiration'] = {'NoncurrentDays': VERSION_RETENTION_DAYS}
+    if totals['transition_savings'] > 0:
+        rule['Transitions'] = [{'Days': TRANSITION_DAYS, 'StorageClass': 'INTELLIGENT_TIERING'}]
+    if totals['delete_markers'] > 0:
+        rule['Expiration'] = {'ExpiredObjectDeleteMarker': True}
+    return rule
+
+# Function to pick the smallest set of lifecycle rules covering the requested share of the savings
+def plan_lifecycle_rules(report, coverage=LIFECYCLE_COVERAGE):
+    total_savings = report['totals']['estimated_monthly_savings']
+    if total_savings <= 0:
+        return []
+    # Prefix rules are disjoint, so taking the largest savings first gives the fewest rules
+    ranked = sorted(report['prefixes'].items(), key=lambda item: item[1]['estimated_monthly_savings'], reverse=True)
+    rules = []
+    covered = 0.0
+    for prefix, totals in ranked:
+        if covered >= total_savings * coverage or totals['estimated_monthly_savings'] <= 0:
+            break
+        rules.append(lifecycle_rule(prefix, totals))
+        covered += totals['estimated_monthly_savings']
+    # Root-level keys have no common prefix to filter on, so covering them needs the bucket-wide rule
+    if len(rules) > MAX_PREFIX_RULES or any(rule['Filter']['Prefix'] == '' for rule in rules):
+        return [lifecycle_rule('', report['totals'])]
+    return rules
+
+# Function to get the current lifecycle rules of a bucket
+def get_lifecycle_rules(bucket_name, client):
+    try:
+        return client.get_bucket_lifecycle_configuration(Bucket=bucket_name)['Rules']
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchLifecycleConfiguration':
+            return []
+        raise
+
+# Function to diff the planned rules against the rules this script manages on the bucket
+def diff_lifecycle_rules(existing_rules, planned_rules):
+    existing = {rule['ID']: rule for rule in existing_rules if rule.get('ID', '').startswith(RULE_ID_PREFIX)}
+    planned = {rule['ID']: rule for rule in planned_rules}
+    diff = {'add': [], 'change': [], 'remove': [], 'unchanged': []}
+    for rule_id, rule in planned.items():
+        if rule_id not in existing:
+            diff['add'].append(rule_id)
+        elif any(existing[rule_id].get(field) != value for field, value in rule.items()) or set(existing[rule_id]) - set(rule) - {'Prefix'}:
+            diff['change'].append(rule_id)
+        else:
+            diff['unchanged'].append(rule_id)
+    diff['remove'] = [rule_id for rule_id in existing if rule_id not in planned]
+    return diff
+
+# Function to apply the planned rules, keeping every rule this script does not manage
+def apply_lifecycle_rules(bucket_name, client, existing_rules, planned_rules):
+    rules = [rule for rule in existing_rules if not rule.get('ID', '').startswith(RULE_ID_PREFIX)] + planned_rules
+    if rules:
+        client.put_bucket_lifecycle_configuration(Bucket=bucket_name, LifecycleConfiguration={'Rules': rules})
+    else:
+        client.delete_bucket_lifecycle(Bucket=bucket_name)
+
+# Function to plan (and optionally apply) the lifecycle configuration of an analyzed bucket
+def synthesize_lifecycle(report, client, coverage=LIFECYCLE_COVERAGE, apply=False):
+    bucket_name = report['bucket']
+    try:
+        planned_rules = plan_lifecycle_rules(report, coverage)
+        existing_rules = get_lifecycle_rules(bucket_name, client)
+        diff = diff_lifecycle_rules(existing_rules, planned_rules)
+        report['lifecycle_plan'] = {'rules': planned_rules, 'diff': diff}
+        if apply and (diff['add'] or diff['change'] or diff['remove']):
+            apply_lifecycle_rules(bucket_name, client, existing_rules, planned_rules)
+            report['lifecycle_plan']['applied'] = True
+        return diff
+    except ClientError as e:
+        print(f"API Error occurred: {e}")
+
+# Function to write the aggregated report as JSON
+def write_report(reports, report_file):
+    with open(report_file, mode='w') as file:
+        json.dump(reports, file, indent=2, default=str)
+
+# Function to find the region of a bucket, or None when it cannot be read (the bucket is then skipped)
+def lookup_bucket_region(bucket_name):
+    try:
+        return get_bucket_region(bucket_name)
+    except ClientError as e:
+        print(f"API Error occurred for bucket {bucket_name}, skipping it: {e}")
+    except Exception as e:
+        print(f"Exception occurred for bucket {bucket_name}, skipping it: {e}")
+
+# Function to group buckets by region
+def group_buckets_by_region(buckets):
+    buckets_by_region = defaultdict(list)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for bucket, region in zip(buckets, executor.map(lookup_bucket_region, buckets)):
+            if region:
+                buckets_by_region[region].append(bucket)
+    return buckets_by_region
+
 # Main function
 def main():
+    parser = argparse.ArgumentParser(description="Analyze versioned buckets for storage cost optimizations")
+    parser.add_argument('--report', default=REPORT_FILE, help="Path of the JSON report")
+    parser.add_argument('--prices', help="JSON file of storage prices per GB-month by storage class")
+    parser.add_argument('--details', action='store_true', help="Print one line per eligible version")
+    parser.add_argument('--delete', action='store_true', help="Delete noncurrent versions past the retention period")
+    parser.add_argument('--dry-run', action='store_true', help="With --delete, only report what would be deleted")
+    parser.add_argument('--journal', default=JOURNAL_FILE, help="Journal file used to resume an interrupted --delete run")
+    parser.add_argument('--plan-lifecycle', action='store_true', help="Synthesize lifecycle rules and diff them against the bucket's configuration")
+    parser.add_argument('--apply-lifecycle', action='store_true', help="Apply the synthesized lifecycle rules")
+    parser.add_argument('--coverage', type=float, default=LIFECYCLE_COVERAGE, help="Share of the savings the lifecycle rules must cover")
+    args = parser.parse_args()
+
+    prices = dict(PRICE_TABLE)
+    if args.prices:
+        with open(args.prices) as file:
+            prices.update(json.load(file))
+
     buckets = list_buckets()
     if not buckets:
         print("No Buckets Found")
-    for bucket in buckets:
-        bucket_analyzer(bucket)
+        return
+    buckets_by_region = group_buckets_by_region(buckets)
+    journal = DeletionJournal(args.journal) if args.delete and not args.dry_run else None
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = {}
+        for region, region_buckets in buckets_by_region.items():
+            client = get_regional_client(region)
+            for bucket in region_buckets:
+                if args.delete:
+                    future = executor.submit(purge_bucket, bucket, client, prices, args.details, journal, args.dry_run)
+                else:
+                    future = executor.submit(bucket_analyzer, bucket, client, prices, args.details)
+                futures[bucket] = (region, future)
+    if journal:
+        journal.close()
+
+    reports = []
+    for bucket, (region, future) in futures.items():
+        report = future.result()
+        if report:
+            report['region'] = region
+            reports.append(report)
+            totals = report['totals']
+            print(f"{bucket}: {totals['expired_noncurrent_versions']} noncurrent versions "
+                  f"({totals['expired_noncurrent_bytes'] / GB:.2f} GB) past {VERSION_RETENTION_DAYS} days, "
+                  f"{totals['transition_bytes'] / GB:.2f} GB eligible for intelligent tier, "
+                  f"{totals['delete_markers']} delete markers, "
+                  f"estimated savings ${totals['estimated_monthly_savings']:.2f}/month")
+            if 'deleted_versions' in report:
+                print(f"{bucket}: {report['deleted_versions']} versions deleted, {report['failed_deletions']} failed")
+            if args.plan_lifecycle or args.apply_lifecycle:
+                diff = synthesize_lifecycle(report, get_regional_client(region), args.coverage, args.apply_lifecycle)
+                if diff:
+                    action = "applied" if report['lifecycle_plan'].get('applied') else "planned"
+                    print(f"{bucket}: lifecycle rules {action}, add {diff['add']}, change {diff['change']}, remove {diff['remove']}")
+    write_report(reports, args.report)
+    print(f"Report written to: {args.report}")
 
 # Main execution
 if __name__ == '__main__':
@@ -4,26 +4,245 @@
 #description:This is the script that analyzes historical resource utilization (EC2, RDS, etc.), combined with real-time metrics. It should recommend scaling actions and suggest the most cost-effective instance types, AZ deployments, and potential Reserved Instance purchases to match future load.
 
 #import sec
+import argparse
 import boto3
-from datetime import datetime, timedelta
+import csv
+import json
+import numpy as np
+import sqlite3
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
 
 # Initialize boto3 clients
 cloudwatch = boto3.client('cloudwatch')
 ec2 = boto3.client('ec2')
+autoscaling = boto3.client('autoscaling')
+
+#constants
+METRICS_CACHE_FILE = 'metrics_cache.db'
+METRIC_PERIOD = 3600  # 1 hour period to reduce the number of datapoints
+MAX_METRIC_QUERIES = 500  # get_metric_data accepts at most 500 queries per call
+BLOCK_SECONDS = 86400  # Cached datapoints are packed one day per row
+NAN = float('nan')
+LOOKBACK_DAYS = 30
+HEADROOM = 0.2  # Capacity kept above the observed p95 demand
+PERCENTILE = 95
+NETWORK_SAMPLE_SECONDS = 300  # Basic monitoring: NetworkIn/NetworkOut datapoints are 5-minute sums
+RECOMMENDATIONS_FILE = 'rightsizing_recommendations.csv'
+PRICING_CACHE_FILE = 'pricing_cache.db'
+PRICING_TTL_DAYS = 30  # Ingested offer files older than this are ignored until re-ingested
+DEFAULT_REGION = 'us-east-1'
+DEFAULT_OS = 'Linux'
+RESERVED_TERM = 'reserved_1yr_no_upfront_standard'
+RESERVED_FALLBACK_RATIO = 0.69  # 1yr no-upfront RI / on-demand, used while no offer file is ingested
+RI_RECOMMENDATIONS_FILE = 'ri_recommendations.csv'
+HOURS_PER_WEEK = 168
+MIN_WEEKLY_HISTORY_DAYS = 14  # Shorter histories fit an hour-of-day profile instead of hour-of-week
+SPOT_PRICE_DESCRIPTION = 'Linux/UNIX'
+#normalized units per instance size, as used by Reserved Instance size flexibility
+SIZE_UNITS = {'nano': 0.25, 'micro': 0.5, 'small': 1, 'medium': 2, 'large': 4, 'xlarge': 8}
+PURCHASE_OPTION_TERMS = {'on_demand': 'on_demand', 'reserved': RESERVED_TERM}
+#Savings Plan offer files name the operation instead of the operating system
+SAVINGS_PLAN_OPERATIONS = {'RunInstances': 'Linux', 'RunInstances:0002': 'Windows', 'RunInstances:0010': 'RHEL', 'RunInstances:000g': 'SUSE'}
+
+RIGHTSIZE_BATCH_INSTANCES = 1000  # Instances whose series are held in memory at once while rightsizing
+#burstable types sustain only this share (%) of each vCPU without spending CPU credits
+BURSTABLE_BASELINE = {
+    't3.nano': 5, 't3.micro': 10, 't3.small': 20, 't3.medium': 20, 't3.large': 30, 't3.xlarge': 40, 't3.2xlarge': 40,
+}
+#instance type -> (vCPUs, memory GiB, baseline network Gbps, on-demand $/hour in us-east-1)
+INSTANCE_CATALOG = {
+    't3.nano': (2, 0.5, 0.032, 0.0052), 't3.micro': (2, 1, 0.064, 0.0104), 't3.small': (2, 2, 0.128, 0.0208),
+    't3.medium': (2, 4, 0.256, 0.0416), 't3.large': (2, 8, 0.512, 0.0832), 't3.xlarge': (4, 16, 1.024, 0.1664),
+    't3.2xlarge': (8, 32, 2.048, 0.3328),
+    'm5.large': (2, 8, 0.75, 0.096), 'm5.xlarge': (4, 16, 1.25, 0.192), 'm5.2xlarge': (8, 32, 2.5, 0.384),
+    'm5.4xlarge': (16, 64, 5.0, 0.768),
+    'c5.large': (2, 4, 0.75, 0.085), 'c5.xlarge': (4, 8, 1.25, 0.17), 'c5.2xlarge': (8, 16, 2.5, 0.34),
+    'c5.4xlarge': (16, 32, 5.0, 0.68),
+    'r5.large': (2, 16, 0.75, 0.126), 'r5.xlarge': (4, 32, 1.25, 0.252), 'r5.2xlarge': (8, 64, 2.5, 0.504),
+    'r5.4xlarge': (16, 128, 5.0, 1.008),
+}
+
+def to_epoch(timestamp):  #naive datetimes from utcnow() are treated as UTC
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return int(timestamp.timestamp())
+
+class MetricsStore:  #local cache of Average/Maximum datapoints, filled only where it has gaps
+    #each row packs one day of a series as two float arrays (NaN where no datapoint was reported)
+    def __init__(self, cache_file=METRICS_CACHE_FILE):
+        self.conn = sqlite3.connect(cache_file, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS series (series_key TEXT PRIMARY KEY, cached_from INTEGER, cached_until INTEGER);
+            CREATE TABLE IF NOT EXISTS blocks (
+                series_key TEXT, block INTEGER, averages BLOB, maximums BLOB,
+                PRIMARY KEY (series_key, block)
+            ) WITHOUT ROWID;
+        """)
+
+    @staticmethod
+    def series_key(namespace, metric_name, dimensions, period):
+        dims = sorted((d['Name'], d['Value']) for d in dimensions)
+        return json.dumps([namespace, metric_name, dims, period])
+
+    def missing_ranges(self, key, start, end):
+        with self.lock:
+            row = self.conn.execute("SELECT cached_from, cached_until FROM series WHERE series_key = ?", (key,)).fetchone()
+        if row is None:
+            return [(start, end)]
+        cached_from, cached_until = row
+        #fetched ranges always reach the cached one, so the recorded range never spans a gap that was not fetched
+        ranges = []
+        if start < cached_from:
+            ranges.append((start, cached_from))
+        if end > cached_until:
+            ranges.append((cached_until, end))
+        return ranges
+
+    def read_blocks(self, key, first_block, last_block):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT block, averages, maximums FROM blocks WHERE series_key = ? AND block BETWEEN ? AND ?",
+                (key, first_block, last_block)).fetchall()
+        blocks = {}
+        for block, averages, maximums in rows:
+            blocks[block] = (array('d'), array('d'))
+            blocks[block][0].frombytes(averages)
+            blocks[block][1].frombytes(maximums)
+        return blocks
+
+    def fetch(self, series, start, end, period):
+        #series: list of (key, namespace, metric_name, dimensions); one Average and one Maximum query each.
+        #each get_metric_data batch is written to the cache before the next one is fetched
+        live = {}
+        batch_series = MAX_METRIC_QUERIES // 2
+        for i in range(0, len(series), batch_series):
+            live.update(self.fetch_batch(series[i:i + batch_series], start, end, period))
+        return live
+
+    def fetch_batch(self, series, start, end, period):
+        queries = []
+        for index, (key, namespace, metric_name, dimensions) in enumerate(series):
+            for stat in ('Average', 'Maximum'):
+                queries.append({
+                    'Id': f"{stat[0].lower()}{index}",
+                    'MetricStat': {
+                        'Metric': {'Namespace': namespace, 'MetricName': metric_name, 'Dimensions': dimensions},
+                        'Period': period,
+                        'Stat': stat,
+                    },
+                })
+        values = defaultdict(dict)
+        next_token = None
+        while True:
+            params = {
+                'MetricDataQueries': queries,
+                'StartTime': datetime.fromtimestamp(start, timezone.utc),
+                'EndTime': datetime.fromtimestamp(end, timezone.utc),
+            }
+            if next_token:
+                params['NextToken'] = next_token
+            response = cloudwatch.get_metric_data(**params)
+            for result in response['MetricDataResults']:
+                values[result['Id']].update(zip((to_epoch(ts) for ts in result['Timestamps']), result['Values']))
+            next_token = response.get('NextToken')
+            if not next_token:
+                break
+
+        #only whole periods that have already ended are cached, the current one is refetched next time
+        complete_until = to_epoch(datetime.now(timezone.utc)) // period * period
+        cached_until = min(end, complete_until)
+        slots = BLOCK_SECONDS // period
+        first_block = start - start % BLOCK_SECONDS
+        last_block = cached_until - cached_until % BLOCK_SECONDS
+        rows = []
+        for index, (key, *_) in enumerate(series):
+            #blocks only partly inside the fetched range keep the datapoints already cached
+            blocks = self.read_blocks(key, first_block, first_block) if start > first_block else {}
+            if last_block != first_block and cached_until > last_block:
+                blocks.update(self.read_blocks(key, last_block, last_block))
+            for column, stat in enumerate('am'):
+                for ts, value in values[f"{stat}{index}"].items():
+                    if ts + period > complete_until:
+                        continue
+                    block = ts - ts % BLOCK_SECONDS
+                    if block not in blocks:
+                        blocks[block] = (array('d', [NAN]) * slots, array('d', [NAN]) * slots)
+                    blocks[block][column][(ts - block) // period] = value
+            rows.extend((key, block, averages.tobytes(), maximums.tobytes()) for block, (averages, maximums) in blocks.items())
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO blocks VALUES (?, ?, ?, ?)", rows)
+            self.conn.executemany("""
+                INSERT INTO series VALUES (?, ?, ?)
+                ON CONFLICT (series_key) DO UPDATE SET
+                    cached_from = MIN(cached_from, excluded.cached_from),
+                    cached_until = MAX(cached_until, excluded.cached_until)
+            """, [(key, start, max(cached_until, start)) for key, *_ in series])
+            self.conn.commit()
+
+        #datapoints of the still-open period are returned but not cached
+        live = {}
+        for index, (key, *_) in enumerate(series):
+            averages, maximums = values[f"a{index}"], values[f"m{index}"]
+            live[key] = {ts: (averages.get(ts, NAN), maximums.get(ts, NAN)) for ts in averages if ts + period > complete_until}
+        return live
+
+    def get_series(self, requests, start_time, end_time, period=METRIC_PERIOD):
+        #requests: list of (namespace, metric_name, dimensions); returns (timestamps, averages, maximums) numpy arrays per request
+        start = to_epoch(start_time) // period * period
+        end = to_epoch(end_time)
+        keys = [self.series_key(namespace, metric_name, dimensions, period) for namespace, metric_name, dimensions in requests]
+
+        #series missing the same range share get_metric_data calls
+        missing = defaultdict(list)
+        for key, (namespace, metric_name, dimensions) in zip(keys, requests):
+            for fetch_range in self.missing_ranges(key, start, end):
+                missing[fetch_range].append((key, namespace, metric_name, dimensions))
+        live = defaultdict(dict)
+        for (fetch_start, fetch_end), series in missing.items():
+            for key, points in self.fetch(series, fetch_start, fetch_end, period).items():
+                live[key].update(points)
+
+        results = []
+        offsets = np.arange(BLOCK_SECONDS // period, dtype=np.int64) * period
+        for key in keys:
+            blocks = sorted(self.read_blocks(key, start - start % BLOCK_SECONDS, end).items())
+            live_points = sorted(live[key].items())
+            timestamps = np.concatenate([block + offsets for block, _ in blocks] + [np.array([ts for ts, _ in live_points], dtype=np.int64)])
+            averages = np.concatenate([np.frombuffer(averages, dtype=np.float64) for _, (averages, _) in blocks]
+                                      + [np.array([average for _, (average, _) in live_points], dtype=np.float64)])
+            maximums = np.concatenate([np.frombuffer(maximums, dtype=np.float64) for _, (_, maximums) in blocks]
+                                      + [np.array([maximum for _, (_, maximum) in live_points], dtype=np.float64)])
+            #NaN marks a missing datapoint
+            keep = ~np.isnan(averages) & (timestamps >= start) & (timestamps < end)
+            results.append((timestamps[keep], averages[keep], maximums[keep]))
+        return results
+
+    def get_datapoints(self, requests, start_time, end_time, period=METRIC_PERIOD):
+        #same as get_series, shaped like get_metric_statistics Datapoints
+        return [
+            [{'Timestamp': datetime.fromtimestamp(int(ts), timezone.utc), 'Average': float(average), 'Maximum': float(maximum)}
+             for ts, average, maximum in zip(timestamps, averages, maximums)]
+            for timestamps, averages, maximums in self.get_series(requests, start_time, end_time, period)
+        ]
+
+metrics_store = None
+
+def get_metrics_store():
+    global metrics_store
+    if metrics_store is None:
+        metrics_store = MetricsStore()
+    return metrics_store
 
 # Define functions to gather data
 def get_historical_metrics(namespace, metric_name, dimensions, start_time, end_time):
     try:
-        response = cloudwatch.get_metric_statistics(
-            Namespace=namespace,
-            MetricName=metric_name,
-            Dimensions=dimensions,
-            StartTime=start_time,
-            EndTime=end_time,
-            Period=3600,  # Increased period to 1 hour to reduce the number of datapoints
-            Statistics=['Average', 'Maximum']
-        )
-        return response['Datapoints']
+        return get_metrics_store().get_datapoints([(namespace, metric_name, dimensions)], start_time, end_time)[0]
     except Exception as e:
         print(f"Error Occured: {e}")
 
@@ -36,30 +255,382 @@ def get_real_time_metrics(namespace, metric_name, dimensions):
     except Exception as e:
         print(f"Error Occured: {e}")
 
-def get_instance_pricing(instance_type, purchase_option):   #Can change those values as requirement
-    pricing_data = {
-        'on_demand': {'t3.micro': 0.0104, 't3.small': 0.0208, 't3.medium': 0.0416, 't3.large': 0.0832},
-        'reserved': {'t3.micro': 0.0072, 't3.small': 0.0144, 't3.medium': 0.0288, 't3.large': 0.0576}
-    }
-    return pricing_data[purchase_option][instance_type]
-
-def recommend_instance_type(current_utilization):  #give recommendations of instance_type based on cpu utilization
-    try:                                            
-        if current_utilization < 20:
-            return 't3.micro'
-        elif current_utilization < 40:
-            return 't3.small'
-        elif current_utilization < 60:
-            return 't3.medium'
+def term_name(*parts):  #e.g. ('reserved', '1yr', 'No Upfront', 'standard') -> 'reserved_1yr_no_upfront_standard'
+    return '_'.join(part.strip().lower().replace(' ', '_') for part in parts if part)
+
+class PriceAccumulator:  #hourly prices per (region, instance_type, os, term); upfront fees are amortized over the lease
+    def __init__(self):
+        self.hourly = defaultdict(float)
+        self.upfront = defaultdict(float)
+        self.lease_years = {}
+
+    def add(self, key, unit, price, lease=None):
+        if unit == 'Quantity':
+            self.upfront[key] = price
+            self.lease_years[key] = int(lease[0]) if lease else 1
+        elif unit == 'Hrs':
+            self.hourly[key] = price
+
+    def prices(self):
+        for key in set(self.hourly) | set(self.upfront):
+            yield key + (self.hourly.get(key, 0.0) + self.upfront.get(key, 0.0) / (self.lease_years.get(key, 1) * 8760),)
+
+def read_offer_csv(offer_file):
+    #Price List CSV files start with a few metadata lines before the header row
+    file = open(offer_file, newline='')
+    reader = csv.reader(file)
+    for row in reader:
+        if row and row[0] == 'SKU':
+            return file, reader, {name: index for index, name in enumerate(row)}
+    file.close()
+    raise ValueError(f"No header row found in {offer_file}")
+
+def parse_ec2_offer_csv(offer_file, accumulator, locations):
+    file, reader, col = read_offer_csv(offer_file)
+    with file:
+        license_col = col.get('License Model')
+        for row in reader:
+            if (row[col['Product Family']] != 'Compute Instance' or row[col['Tenancy']] != 'Shared'
+                    or row[col['Pre Installed S/W']] != 'NA' or row[col['Capacity Status']] != 'Used'
+                    or (license_col is not None and row[license_col] == 'Bring your own license')):
+                continue
+            region = row[col['Region Code']]
+            locations[row[col['Location']]] = region
+            if row[col['TermType']] == 'OnDemand':
+                term = 'on_demand'
+            else:
+                term = term_name('reserved', row[col['LeaseContractLength']], row[col['PurchaseOption']], row[col['OfferingClass']])
+            key = (region, row[col['Instance Type']], row[col['Operating System']], term)
+            accumulator.add(key, row[col['Unit']], float(row[col['PricePerUnit']]), row[col['LeaseContractLength']])
+
+def parse_ec2_offer_json(offer_file, accumulator, locations):
+    import ijson  #optional dependency, only needed for JSON offer files
+    products = {}
+    with open(offer_file, 'rb') as file:
+        for sku, product in ijson.kvitems(file, 'products'):
+            attributes = product.get('attributes', {})
+            if (product.get('productFamily') != 'Compute Instance' or attributes.get('tenancy') != 'Shared'
+                    or attributes.get('preInstalledSw') != 'NA' or attributes.get('capacitystatus') != 'Used'
+                    or attributes.get('licenseModel') == 'Bring your own license'):
+                continue
+            locations[attributes['location']] = attributes['regionCode']
+            products[sku] = (attributes['regionCode'], attributes['instanceType'], attributes['operatingSystem'])
+    for term_type in ('OnDemand', 'Reserved'):
+        with open(offer_file, 'rb') as file:
+            for sku, offers in ijson.kvitems(file, f'terms.{term_type}'):
+                if sku not in products:
+                    continue
+                for offer in offers.values():
+                    attributes = offer.get('termAttributes', {})
+                    if term_type == 'OnDemand':
+                        term = 'on_demand'
+                    else:
+                        term = term_name('reserved', attributes['LeaseContractLength'], attributes['PurchaseOption'], attributes['OfferingClass'])
+                    for dimension in offer['priceDimensions'].values():
+                        accumulator.add(products[sku] + (term,), dimension['unit'], float(dimension['pricePerUnit']['USD']),
+                                        attributes.get('LeaseContractLength'))
+
+def parse_savings_plan_csv(offer_file, accumulator, locations):
+    file, reader, col = read_offer_csv(offer_file)
+    with file:
+        for row in reader:
+            usage_type = row[col['DiscountedUsageType']]
+            operating_system = SAVINGS_PLAN_OPERATIONS.get(row[col['DiscountedOperation']])
+            region = locations.get(row[col['Location']])
+            if 'BoxUsage:' not in usage_type or operating_system is None or region is None:
+                continue
+            term = term_name('savings_plan', row[col['LeaseContractLength']] + 'yr', row[col['PurchaseOption']])
+            accumulator.add((region, usage_type.split('BoxUsage:')[1], operating_system, term), 'Hrs', float(row[col['DiscountedRate']]))
+
+class PricingCatalog:  #indexed local cache of ingested offer files; lookups are served from memory per region
+    def __init__(self, cache_file=PRICING_CACHE_FILE, ttl_days=PRICING_TTL_DAYS):
+        self.conn = sqlite3.connect(cache_file, check_same_thread=False)
+        self.ttl_seconds = ttl_days * 86400
+        self.regions = {}
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS prices (
+                region TEXT, instance_type TEXT, os TEXT, term TEXT, price REAL,
+                PRIMARY KEY (region, instance_type, os, term)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS locations (location TEXT PRIMARY KEY, region TEXT);
+            CREATE TABLE IF NOT EXISTS meta (ingested_at REAL);
+        """)
+
+    def ingest(self, offer_file):
+        #offer files are streamed; only the compute rows we price are kept, aggregated per key
+        accumulator = PriceAccumulator()
+        locations = dict(self.conn.execute("SELECT location, region FROM locations").fetchall())
+        with open(offer_file, newline='') as file:
+            header = ''.join(next(file, '') for _ in range(12))
+        if offer_file.endswith('.json'):
+            parse_ec2_offer_json(offer_file, accumulator, locations)
+        elif 'DiscountedRate' in header:
+            parse_savings_plan_csv(offer_file, accumulator, locations)
         else:
-            return 't3.large'
+            parse_ec2_offer_csv(offer_file, accumulator, locations)
+        rows = list(accumulator.prices())
+        self.conn.executemany("INSERT OR REPLACE INTO prices VALUES (?, ?, ?, ?, ?)", rows)
+        self.conn.executemany("INSERT OR REPLACE INTO locations VALUES (?, ?)", locations.items())
+        self.conn.execute("DELETE FROM meta")
+        self.conn.execute("INSERT INTO meta VALUES (?)", (time.time(),))
+        self.conn.commit()
+        self.regions = {}
+        return len(rows)
+
+    def is_fresh(self):
+        row = self.conn.execute("SELECT ingested_at FROM meta").fetchone()
+        return row is not None and time.time() - row[0] < self.ttl_seconds
+
+    def lookup(self, region, instance_type, os=DEFAULT_OS, term='on_demand'):
+        prices = self.regions.get(region)
+        if prices is None:
+            prices = self.regions[region] = {} if not self.is_fresh() else {
+                (instance_type, os, term): price for instance_type, os, term, price in self.conn.execute(
+                    "SELECT instance_type, os, term, price FROM prices WHERE region = ?", (region,))
+            }
+        return prices.get((instance_type, os, term))
+
+pricing_catalog = None
+
+def get_pricing_catalog():
+    global pricing_catalog
+    if pricing_catalog is None:
+        pricing_catalog = PricingCatalog()
+    return pricing_catalog
+
+def get_instance_pricing(instance_type, purchase_option, region=DEFAULT_REGION, os=DEFAULT_OS):
+    #purchase_option is 'on_demand', 'reserved' or any ingested term name (e.g. 'savings_plan_1yr_no_upfront')
+    price = get_pricing_catalog().lookup(region, instance_type, os, PURCHASE_OPTION_TERMS.get(purchase_option, purchase_option))
+    if price is not None:
+        return price
+    #built-in us-east-1 Linux prices until an offer file has been ingested
+    on_demand = INSTANCE_CATALOG[instance_type][3]
+    return on_demand * RESERVED_FALLBACK_RATIO if purchase_option == 'reserved' else on_demand
+
+def sustained_vcpus(instance_type, catalog=INSTANCE_CATALOG):
+    #vCPUs a type can run at indefinitely; burstable types only up to their baseline without exhausting credits
+    return catalog[instance_type][0] * BURSTABLE_BASELINE.get(instance_type, 100) / 100
+
+class CapacityIndex:  #cheapest instance type for every (vCPU, memory, network) threshold, precomputed once
+    def __init__(self, catalog=INSTANCE_CATALOG):
+        self.vcpus = sorted({sustained_vcpus(instance_type, catalog) for instance_type in catalog})
+        self.memory = sorted({spec[1] for spec in catalog.values()})
+        self.network = sorted({spec[2] for spec in catalog.values()})
+        self.cheapest = {}
+        #cell (i, j, k) holds the cheapest type with at least vcpus[i] sustained vCPUs, memory[j] and network[k]
+        for instance_type, (_, memory, network, price) in sorted(catalog.items(), key=lambda item: item[1][3], reverse=True):
+            vcpus = sustained_vcpus(instance_type, catalog)
+            for i in range(bisect_left(self.vcpus, vcpus) + 1):
+                for j in range(bisect_left(self.memory, memory) + 1):
+                    for k in range(bisect_left(self.network, network) + 1):
+                        self.cheapest[i, j, k] = instance_type
+
+    def lookup(self, vcpus, memory, network):
+        i = bisect_left(self.vcpus, vcpus)
+        j = bisect_left(self.memory, memory)
+        k = bisect_left(self.network, network)
+        return self.cheapest.get((i, j, k))  #None when no type is large enough
+
+capacity_index = CapacityIndex()
+
+def percentile(values, pct=PERCENTILE):
+    if len(values) == 0:
+        return None
+    return float(np.percentile(values, pct, method='nearest'))
+
+def recommend_instance_type(instance_type, cpu_p95, memory_p95=None, network_p95=None, headroom=HEADROOM):
+    #give the cheapest instance type whose capacity covers the p95 demand plus headroom
+    try:
+        vcpus, memory, network, _ = INSTANCE_CATALOG[instance_type]
+        needed_vcpus = vcpus * (cpu_p95 or 0) / 100 * (1 + headroom)
+        #without a memory metric the current memory size is kept
+        needed_memory = memory * memory_p95 / 100 * (1 + headroom) if memory_p95 is not None else memory
+        needed_network = (network_p95 or 0) * 8 / 1e9 * (1 + headroom)
+        return capacity_index.lookup(needed_vcpus, needed_memory, needed_network) or instance_type
     except Exception as e:
         print(f"Error Occured:{e}")
 
-def recommend_reserved_instances(instance_type):   #recommend reserved or on-demand based on the workload
+def list_instances():
+    paginator = ec2.get_paginator('describe_instances')
+    instances = []
+    for page in paginator.paginate(Filters=[{'Name': 'instance-state-name', 'Values': ['running']}]):
+        for reservation in page['Reservations']:
+            instances.extend(reservation['Instances'])
+    return instances
+
+def rightsize_fleet(lookback_days=LOOKBACK_DAYS, headroom=HEADROOM, instances=None):
+    #recommend an instance type for every running instance from its CPU, network and memory percentiles
+    end_time = datetime.utcnow()
+    start_time = end_time - timedelta(days=lookback_days)
+    instances = instances or list_instances()
+    recommendations = []
+    skipped = []
+    for instance in instances:
+        if instance['InstanceType'] not in INSTANCE_CATALOG:
+            skipped.append(skipped_recommendation(instance, "Instance type not in INSTANCE_CATALOG"))
+    catalogued = [instance for instance in instances if instance['InstanceType'] in INSTANCE_CATALOG]
+
+    #series are fetched per batch of instances so only one batch of arrays is held in memory
+    for i in range(0, len(catalogued), RIGHTSIZE_BATCH_INSTANCES):
+        batch = catalogued[i:i + RIGHTSIZE_BATCH_INSTANCES]
+        requests = []
+        for instance in batch:
+            dimensions = [{'Name': 'InstanceId', 'Value': instance['InstanceId']}]
+            requests.append(('AWS/EC2', 'CPUUtilization', dimensions))
+            requests.append(('AWS/EC2', 'NetworkIn', dimensions))
+            requests.append(('AWS/EC2', 'NetworkOut', dimensions))
+            requests.append(('CWAgent', 'mem_used_percent', dimensions))  #only published where the CloudWatch agent runs
+        series = get_metrics_store().get_series(requests, start_time, end_time)
+
+        for index, instance in enumerate(batch):
+            (_, cpu, _), (in_ts, network_in, _), (out_ts, network_out, _), (_, memory, _) = series[4 * index:4 * index + 4]
+            #NetworkOut is added to NetworkIn at matching timestamps
+            positions = np.minimum(np.searchsorted(out_ts, in_ts), max(len(out_ts) - 1, 0))
+            matched = out_ts[positions] == in_ts if len(out_ts) else np.zeros(len(in_ts), dtype=bool)
+            network = network_in + np.where(matched, network_out[positions] if len(out_ts) else 0, 0)
+            cpu_p95 = percentile(cpu)
+            network_p95 = percentile(network / NETWORK_SAMPLE_SECONDS)
+            memory_p95 = percentile(memory)
+            if cpu_p95 is None:
+                skipped.append(skipped_recommendation(instance, "No CPUUtilization datapoints in the lookback"))
+                continue
+            current_type = instance['InstanceType']
+            recommended_type = recommend_instance_type(current_type, cpu_p95, memory_p95, network_p95, headroom)
+            recommendations.append({
+                'InstanceId': instance['InstanceId'],
+                'AvailabilityZone': instance['Placement']['AvailabilityZone'],
+                'CurrentType': current_type,
+                'RecommendedType': recommended_type,
+                'CpuP95': round(cpu_p95, 2),
+                'MemoryP95': round(memory_p95, 2) if memory_p95 is not None else '',
+                'NetworkP95BytesPerSec': round(network_p95 or 0, 2),
+                'MonthlySavings': round((INSTANCE_CATALOG[current_type][3] - INSTANCE_CATALOG[recommended_type][3]) * 730, 2),
+                'Note': '',
+            })
+    if skipped:
+        print(f"Skipped {len(skipped)} instances without a recommendation (see the Note column)")
+    return recommendations + skipped
+
+def skipped_recommendation(instance, note):
+    #a row for an instance that could not be rightsized, so every instance appears in the output
+    return {
+        'InstanceId': instance['InstanceId'],
+        'AvailabilityZone': instance['Placement']['AvailabilityZone'],
+        'CurrentType': instance['InstanceType'],
+        'RecommendedType': instance['InstanceType'],
+        'CpuP95': '',
+        'MemoryP95': '',
+        'NetworkP95BytesPerSec': '',
+        'MonthlySavings': 0,
+        'Note': note,
+    }
+
+def write_recommendations(recommendations, output_file=RECOMMENDATIONS_FILE):
+    with open(output_file, mode='w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=list(recommendations[0]))
+        writer.writeheader()
+        writer.writerows(recommendations)
+
+def size_units(instance_type):
+    size = instance_type.split('.')[1]
+    if size.endswith('xlarge') and size[:-6].isdigit():
+        return 8 * int(size[:-6])
+    return SIZE_UNITS.get(size)
+
+def family_unit_prices(family, region):
+    #hourly on-demand and reserved price of one normalized unit, from the smallest priced size of the family
+    for instance_type in sorted((t for t in INSTANCE_CATALOG if t.split('.')[0] == family), key=size_units):
+        units = size_units(instance_type)
+        return (get_instance_pricing(instance_type, 'on_demand', region) / units,
+                get_instance_pricing(instance_type, 'reserved', region) / units)
+    return None
+
+def forecast_weekly_profile(demand, first_hour):
+    #seasonal baseline: mean demand per hour of the week, or per hour of the day tiled over the week
+    hours = np.arange(first_hour, first_hour + demand.shape[1])
+    if demand.shape[1] >= MIN_WEEKLY_HISTORY_DAYS * 24:
+        slots, slot_count = hours % HOURS_PER_WEEK, HOURS_PER_WEEK
+    else:
+        slots, slot_count = hours % 24, 24
+    counts = np.maximum(np.bincount(slots, minlength=slot_count), 1)
+    profile = np.stack([np.bincount(slots, weights=row, minlength=slot_count) for row in demand]) / counts
+    return np.tile(profile, (1, HOURS_PER_WEEK // slot_count))
+
+def optimize_commitment(profiles, on_demand_rates, reserved_rates):
+    #expected hourly cost of every candidate commitment, for all families at once:
+    #  cost(c) = c * reserved + mean(max(demand - c, 0)) * on_demand, minimized over c in the forecast levels
+    levels = np.concatenate([np.zeros((profiles.shape[0], 1)), np.sort(profiles, axis=1)], axis=1)
+    shortfall = np.maximum(profiles[:, None, :] - levels[:, :, None], 0).mean(axis=2)
+    costs = levels * reserved_rates[:, None] + shortfall * on_demand_rates[:, None]
+    best = costs.argmin(axis=1)
+    rows = np.arange(profiles.shape[0])
+    return levels[rows, best], costs[rows, best], costs[:, 0]
+
+def plan_reserved_capacity(instances, lookback_days=LOOKBACK_DAYS):
+    #forecast normalized-unit demand per (region, family) from hourly history and pick the cheapest commitment
+    end_time = datetime.utcnow()
+    start_time = end_time - timedelta(days=lookback_days)
+    first_hour = to_epoch(start_time) // 3600
+    hours = int(to_epoch(end_time) // 3600 - first_hour)
+    instances = [instance for instance in instances if size_units(instance['InstanceType'])]
+    requests = [('AWS/EC2', 'CPUUtilization', [{'Name': 'InstanceId', 'Value': instance['InstanceId']}]) for instance in instances]
+    series = get_metrics_store().get_series(requests, start_time, end_time)
+
+    #an instance counts towards demand in every hour it reported a datapoint
+    groups = {}
+    demand = []
+    for instance, points in zip(instances, series):
+        group = (instance['Placement']['AvailabilityZone'][:-1], instance['InstanceType'].split('.')[0])
+        if group not in groups:
+            groups[group] = len(demand)
+            demand.append(np.zeros(hours))
+        slots = points[0] // 3600 - first_hour
+        slots = slots[(slots >= 0) & (slots < hours)]
+        np.add.at(demand[groups[group]], slots, size_units(instance['InstanceType']))
+    if not groups:
+        return []
+
+    rates = [family_unit_prices(family, region) for region, family in groups]
+    priced = [index for index, rate in enumerate(rates) if rate]
+    group_keys = list(groups)
+    unpriced = sorted({f"{group_keys[index][1]} ({group_keys[index][0]})" for index, rate in enumerate(rates) if not rate})
+    if unpriced:
+        print(f"No reserved capacity plan for families without a price in INSTANCE_CATALOG: {', '.join(unpriced)}")
+    if not priced:
+        return []
+    profiles = forecast_weekly_profile(np.stack([demand[index] for index in priced]), first_hour)
+    on_demand_rates = np.array([rates[index][0] for index in priced])
+    reserved_rates = np.array([rates[index][1] for index in priced])
+    commitments, committed_costs, on_demand_costs = optimize_commitment(profiles, on_demand_rates, reserved_rates)
+
+    plan = []
+    for row, index in enumerate(priced):
+        region, family = group_keys[index]
+        plan.append({
+            'Region': region,
+            'Family': family,
+            'ForecastAverageUnits': round(float(profiles[row].mean()), 2),
+            'ForecastPeakUnits': round(float(profiles[row].max()), 2),
+            'CommitmentUnits': round(float(commitments[row]), 2),
+            'HourlyCostOnDemand': round(float(on_demand_costs[row]), 4),
+            'HourlyCostWithCommitment': round(float(committed_costs[row]), 4),
+            'MonthlySavings': round(float(on_demand_costs[row] - committed_costs[row]) * 730, 2),
+        })
+    return plan
+
+def recommend_reserved_instances(instance_type, region=DEFAULT_REGION, plan=None):   #recommend reserved or on-demand based on the workload
     try:
-        ri_pricing = get_instance_pricing(instance_type, 'reserved')
-        on_demand_pricing = get_instance_pricing(instance_type, 'on_demand')
+        family = instance_type.split('.')[0]
+        for entry in plan or []:
+            if entry['Region'] == region and entry['Family'] == family:
+                if entry['CommitmentUnits'] <= 0:
+                    return "Stick with On-Demand Instances"
+                units = size_units(instance_type)
+                return (f"Purchase Reserved Instances for {entry['CommitmentUnits']:g} normalized units of {family} in {region} "
+                        f"(~{entry['CommitmentUnits'] / units:.1f} x {instance_type}), saving ${entry['MonthlySavings']:.2f}/month")
+
+        ri_pricing = get_instance_pricing(instance_type, 'reserved', region)
+        on_demand_pricing = get_instance_pricing(instance_type, 'on_demand', region)
         
         if ri_pricing < on_demand_pricing * 0.75:  # Arbitrary threshold for cost-effectiveness
             return f"Purchase Reserved Instances for {instance_type}"
@@ -68,67 +639,176 @@ def recommend_reserved_instances(instance_type):   #recommend reserved or on-dem
     except Exception as e:
         print(f"Error occurred:{e}")
 
-def recommend_az_deployments(instance_id):
+def count_instances_by_az(auto_scaling_group=None, instances=None):
+    #instances per AZ plus the AZs they may be placed in, from one paginated describe call
+    counts = defaultdict(int)
+    if auto_scaling_group:
+        paginator = autoscaling.get_paginator('describe_auto_scaling_groups')
+        zones = []
+        for page in paginator.paginate(AutoScalingGroupNames=[auto_scaling_group]):
+            for group in page['AutoScalingGroups']:
+                zones.extend(group['AvailabilityZones'])
+                for instance in group['Instances']:
+                    counts[instance['AvailabilityZone']] += 1
+        return counts, zones
+    for instance in instances if instances is not None else list_instances():
+        counts[instance['Placement']['AvailabilityZone']] += 1
+    response = ec2.describe_availability_zones(Filters=[{'Name': 'state', 'Values': ['available']},
+                                                        {'Name': 'zone-type', 'Values': ['availability-zone']}])
+    return counts, [zone['ZoneName'] for zone in response['AvailabilityZones']]
+
+def spot_price_weights(instance_type, zones):
+    #weight each AZ by the inverse of its latest spot price, cheaper AZs take a larger share
+    paginator = ec2.get_paginator('describe_spot_price_history')
+    latest = {}
+    for page in paginator.paginate(InstanceTypes=[instance_type], ProductDescriptions=[SPOT_PRICE_DESCRIPTION],
+                                   StartTime=datetime.utcnow() - timedelta(hours=1)):
+        for entry in page['SpotPriceHistory']:
+            zone = entry['AvailabilityZone']
+            if zone in zones and (zone not in latest or entry['Timestamp'] > latest[zone][0]):
+                latest[zone] = (entry['Timestamp'], float(entry['SpotPrice']))
+    return {zone: 1 / price for zone, (_, price) in latest.items() if price > 0}
+
+def plan_az_rebalance(counts, zones, weights=None):
+    #target counts proportional to the AZ weights (largest remainder), then the fewest moves to reach them
+    zones = sorted(set(zones) | set(counts))
+    weights = {zone: weights.get(zone, 0) for zone in zones} if weights else dict.fromkeys(zones, 1)
+    total_weight = sum(weights.values())
+    if not total_weight:
+        weights, total_weight = dict.fromkeys(zones, 1), len(zones)
+    total = sum(counts.values())
+    quotas = {zone: total * weights[zone] / total_weight for zone in zones}
+    target = {zone: int(quotas[zone]) for zone in zones}
+
+    #hand the leftover instances to AZs with a fractional quota, first to those already above their floor
+    #(rounding one of those up saves a move), then by largest remainder
+    leftover = total - sum(target.values())
+    by_remainder = sorted(zones, key=lambda zone: (quotas[zone] > target[zone], counts.get(zone, 0) > target[zone],
+                                                   quotas[zone] - target[zone], counts.get(zone, 0)), reverse=True)
+    for zone in by_remainder[:leftover]:
+        target[zone] += 1
+
+    #every surplus instance moves exactly once, so the number of moves is the total surplus, which is the minimum
+    surplus = [[zone, counts.get(zone, 0) - target[zone]] for zone in zones if counts.get(zone, 0) > target[zone]]
+    deficit = [[zone, target[zone] - counts.get(zone, 0)] for zone in zones if counts.get(zone, 0) < target[zone]]
+    moves = []
+    i = j = 0
+    while i < len(surplus) and j < len(deficit):
+        count = min(surplus[i][1], deficit[j][1])
+        moves.append({'From': surplus[i][0], 'To': deficit[j][0], 'Count': count})
+        surplus[i][1] -= count
+        deficit[j][1] -= count
+        if not surplus[i][1]:
+            i += 1
+        if not deficit[j][1]:
+            j += 1
+    return {'Current': {zone: counts.get(zone, 0) for zone in zones}, 'Target': target, 'Moves': moves}
+
+def recommend_az_deployments(auto_scaling_group=None, instance_type=None, weights=None, instances=None):
+    #rebalance the fleet (or one Auto Scaling group) across its AZs, optionally weighted by spot price or capacity
     try:
-        response = ec2.describe_instances(InstanceIds=[instance_id])
-        availability_zones = [res['Instances'][0]['Placement']['AvailabilityZone'] for res in response['Reservations']]
-    #logic to recommend spreading instances across AZs
-    
-        az_recommendations = {}
-        for az in set(availability_zones):
-            az_recommendations[az] = availability_zones.count(az)
-        
-        total_instances = sum(az_recommendations.values())
-        recommended_azs = {az: total_instances // len(az_recommendations) for az in az_recommendations}
-        
-        for az in az_recommendations:
-            if az_recommendations[az] > recommended_azs[az]:
-                diff = az_recommendations[az] - recommended_azs[az]
-                for target_az in az_recommendations:
-                    if az_recommendations[target_az] < recommended_azs[target_az]:
-                        move_count = min(diff, recommended_azs[target_az] - az_recommendations[target_az])
-                        az_recommendations[az] -= move_count
-                        az_recommendations[target_az] += move_count
-                        if diff == 0:
-                            break
-        
-        return az_recommendations
+        counts, zones = count_instances_by_az(auto_scaling_group, instances)
+        if weights is None and instance_type:
+            weights = spot_price_weights(instance_type, zones)
+        return plan_az_rebalance(counts, zones, weights)
     except Exception as e:
         print(f"Error Occurred as {e}")
-# Example usage
-namespace = 'AWS/EC2'
-metric_name = 'CPUUtilization' 
-dimensions = [{'Name': 'InstanceId', 'Value': 'i-0b03a300c2b1882f3'}] # Update the Instance ID to your actual Instance ID
-
-# Get historical metrics
-start_time = datetime.utcnow() - timedelta(days=30)
-end_time = datetime.utcnow()
-historical_metrics = get_historical_metrics(namespace, metric_name, dimensions, start_time, end_time)
-
-# Check if historical metrics data is available and gather cpu utilization
-if historical_metrics:
-    average_utilization = sum(dp['Average'] for dp in historical_metrics) / len(historical_metrics)
-else:
-    average_utilization = 0
-    print("No historical metrics data available.")
-
-# Get real-time metrics and gather cpu utilization
-real_time_metrics = get_real_time_metrics(namespace, metric_name, dimensions)
-
-# Check if real-time metrics data is available and gather current utilization
-if real_time_metrics:
-    current_utilization = sum(dp['Average'] for dp in real_time_metrics) / len(real_time_metrics)
-else:
-    current_utilization = 0
-    print("No real-time metrics data available.")
-
-# Analyze metrics and make recommendations
-recommended_instance_type = recommend_instance_type(current_utilization)
-reserved_instance_recommendation = recommend_reserved_instances(recommended_instance_type)
-az_deployment_recommendation = recommend_az_deployments('i-0b03a300c2b1882f3')
-
-print(f"Average Utilization: {average_utilization:.2f}%")
-print(f"Current Utilization: {current_utilization:.2f}%")
-print(f"Recommended Instance Type: {recommended_instance_type}")
-print(f"Reserved Instance Recommendation: {reserved_instance_recommendation}")
-print(f"AZ Deployment Recommendation: {az_deployment_recommendation}")
+
+def analyze_instance(instance_id):
+    namespace = 'AWS/EC2'
+    metric_name = 'CPUUtilization' 
+    dimensions = [{'Name': 'InstanceId', 'Value': instance_id}]
+    instance = ec2.describe_instances(InstanceIds=[instance_id])['Reservations'][0]['Instances'][0]
+    instance_type = instance['InstanceType']
+    tags = {tag['Key']: tag['Value'] for tag in instance.get('Tags', [])}
+
+    # Get historical metrics
+    start_time = datetime.utcnow() - timedelta(days=LOOKBACK_DAYS)
+    end_time = datetime.utcnow()
+    historical_metrics = get_historical_metrics(namespace, metric_name, dimensions, start_time, end_time)
+
+    # Check if historical metrics data is available and gather cpu utilization
+    if historical_metrics:
+        average_utilization = sum(dp['Average'] for dp in historical_metrics) / len(historical_metrics)
+        cpu_p95 = percentile([dp['Average'] for dp in historical_metrics])
+    else:
+        average_utilization = 0
+        cpu_p95 = 0
+        print("No historical metrics data available.")
+
+    # Get real-time metrics and gather cpu utilization
+    real_time_metrics = get_real_time_metrics(namespace, metric_name, dimensions)
+
+    # Check if real-time metrics data is available and gather current utilization
+    if real_time_metrics:
+        current_utilization = sum(dp['Average'] for dp in real_time_metrics) / len(real_time_metrics)
+    else:
+        current_utilization = 0
+        print("No real-time metrics data available.")
+
+    # Analyze metrics and make recommendations
+    recommended_instance_type = recommend_instance_type(instance_type, max(cpu_p95, current_utilization))
+    reserved_instance_recommendation = recommend_reserved_instances(recommended_instance_type)
+    az_deployment_recommendation = recommend_az_deployments(tags.get('aws:autoscaling:groupName'))
+
+    print(f"Average Utilization: {average_utilization:.2f}%")
+    print(f"Current Utilization: {current_utilization:.2f}%")
+    print(f"Recommended Instance Type: {recommended_instance_type}")
+    print(f"Reserved Instance Recommendation: {reserved_instance_recommendation}")
+    print(f"AZ Deployment Recommendation: {az_deployment_recommendation}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Cost-aware scaling recommendations")
+    parser.add_argument('--instance-id', help="Analyze a single instance instead of the whole fleet")
+    parser.add_argument('--lookback-days', type=int, default=LOOKBACK_DAYS, help="Days of history used for the percentiles")
+    parser.add_argument('--headroom', type=float, default=HEADROOM, help="Capacity kept above the p95 demand (0.2 = 20%%)")
+    parser.add_argument('--output', default=RECOMMENDATIONS_FILE, help="Path of the recommendations CSV")
+    parser.add_argument('--ri-output', default=RI_RECOMMENDATIONS_FILE, help="Path of the Reserved Instance plan CSV")
+    parser.add_argument('--az-rebalance', nargs='?', const='', metavar='ASG_NAME',
+                        help="Plan an AZ rebalance for the fleet, or for one Auto Scaling group")
+    parser.add_argument('--spot-weights', metavar='INSTANCE_TYPE', help="Weight the AZ rebalance by spot prices of this instance type")
+    parser.add_argument('--ingest-pricing', nargs='+', metavar='OFFER_FILE',
+                        help="Ingest AWS Price List offer files (EC2 CSV/JSON, Compute Savings Plan CSV) into the pricing cache")
+    args = parser.parse_args()
+
+    if args.ingest_pricing:
+        catalog = get_pricing_catalog()
+        for offer_file in args.ingest_pricing:
+            print(f"Ingesting pricing offer file: {offer_file}")
+            print(f"Stored {catalog.ingest(offer_file)} prices")
+        return
+
+    if args.instance_id:
+        analyze_instance(args.instance_id)
+        return
+
+    if args.az_rebalance is not None:
+        plan = recommend_az_deployments(args.az_rebalance or None, args.spot_weights)
+        if plan:
+            for zone, target in plan['Target'].items():
+                print(f"{zone}: {plan['Current'][zone]} -> {target}")
+            for move in plan['Moves']:
+                print(f"Move {move['Count']} instances from {move['From']} to {move['To']}")
+        return
+
+    instances = list_instances()
+    recommendations = rightsize_fleet(args.lookback_days, args.headroom, instances)
+    if not recommendations:
+        print("No running instances found.")
+        return
+    plan = plan_reserved_capacity(instances, args.lookback_days)
+    for recommendation in recommendations:
+        recommendation['ReservedInstanceRecommendation'] = '' if recommendation['Note'] else recommend_reserved_instances(
+            recommendation['RecommendedType'], recommendation['AvailabilityZone'][:-1], plan)
+    write_recommendations(recommendations, args.output)
+    resized = [r for r in recommendations if r['RecommendedType'] != r['CurrentType']]
+    print(f"Analyzed {len(recommendations)} instances, {len(resized)} rightsizing recommendations, "
+          f"estimated savings ${sum(r['MonthlySavings'] for r in resized):.2f}/month")
+    print(f"Recommendations written to: {args.output}")
+    if plan:
+        write_recommendations(plan, args.ri_output)
+        print(f"Reserved Instance plan for {len(plan)} families, estimated savings "
+              f"${sum(entry['MonthlySavings'] for entry in plan):.2f}/month, written to: {args.ri_output}")
+
+if __name__ == '__main__':
+    main()
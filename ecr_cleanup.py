@@ -1,82 +1,233 @@
+import argparse
 import boto3
+import json
+import re
+import time
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta, timezone
 
-# Initialize the ECR client
-ecr_client = boto3.client('ecr')
-
 # Define constants
 RETENTION_PERIOD = 1  # For testing, set to 1 day
 MIN_IMG_KEPT = 5
+MAX_WORKERS = 16  # Number of repositories cleaned concurrently
+DELETE_BATCH_SIZE = 100  # batch_delete_image accepts at most 100 image ids per call
+GET_IMAGE_BATCH_SIZE = 100  # batch_get_image accepts at most 100 image ids per call
+MANIFEST_LIST_TYPES = ('application/vnd.docker.distribution.manifest.list.v2+json', 'application/vnd.oci.image.index.v1+json')
+SEMVER_TAG = re.compile(r'^v?\d+\.\d+\.\d+(?:-[0-9A-Za-z.-]+)?(?:\+[0-9A-Za-z.-]+)?$')
+# Default retention rules; an image is kept when any rule matches
+RETENTION_POLICY = {
+    'keep_semver': True,            # keep images carrying a semver tag such as v1.2.3
+    'keep_last_per_tag_prefix': {}, # keep the newest N images per tag prefix, e.g. {'release-': 10}
+    'keep_pulled_days': 14,         # keep anything pulled within this many days
+}
+
+# Function to create the ECR client, its connection pool sized for the workers and retries backing off on throttling
+def create_ecr_client(max_workers=MAX_WORKERS):
+    return boto3.client('ecr', config=Config(max_pool_connections=max_workers, retries={'mode': 'adaptive', 'max_attempts': 10}))
+
+# Initialize the ECR client
+ecr_client = create_ecr_client()
 
 # Function to list all ECR repositories
 def list_ecr_repo():
     try:
-        response = ecr_client.describe_repositories()
-        return [repo['repositoryName'] for repo in response['repositories']]
+        paginator = ecr_client.get_paginator('describe_repositories')
+        return [repo['repositoryName'] for page in paginator.paginate() for repo in page['repositories']]
     except ClientError as e:
         print(f"API Error Occurred: {e}")
         return []
 
-# Function to list images in a repository
+# Function to list images in a repository, returns None when they could not be listed
 def list_images(repository_name):
     try:
-        response = ecr_client.describe_images(repositoryName=repository_name)
-        images = response['imageDetails']
+        paginator = ecr_client.get_paginator('describe_images')
+        images = [image for page in paginator.paginate(repositoryName=repository_name) for image in page['imageDetails']]
         return sorted(images, key=lambda x: x['imagePushedAt'])
     except ClientError as e:
         print(f"API Error Occurred: {e}")
-        return []
+        return None
 
-# Function to delete images
+# Function to delete images, returns the number deleted and the failures
 def delete_images(repository_name, image_ids):
+    deleted_count = 0
+    failures = []
     try:
-        # Batch delete images (max 1000 per request)
-        for i in range(0, len(image_ids), 1000):
-            batch = image_ids[i:i+1000]
+        # Batch delete images (max 100 per request)
+        for i in range(0, len(image_ids), DELETE_BATCH_SIZE):
+            batch = image_ids[i:i+DELETE_BATCH_SIZE]
             response = ecr_client.batch_delete_image(
                 repositoryName=repository_name,
                 imageIds=batch
             )
             deleted = response.get('imageIds', [])
+            deleted_count += len(deleted)
             if deleted:
-                print(f"Successfully deleted images: {[img['imageDigest'] for img in deleted]}")
-            if 'failures' in response:
-                print(f"Failures: {response['failures']}")
+                print(f"Successfully deleted {len(deleted)} images from repository {repository_name}")
+            if response.get('failures'):
+                failures.extend(response['failures'])
+                print(f"Failures in repository {repository_name}: {response['failures']}")
     except ClientError as e:
         print(f"API Error Occurred: {e}")
+        failures.append({'failureReason': str(e)})
     except Exception as e:
         print(f"Exception Occurred: {e}")
+        failures.append({'failureReason': str(e)})
+    return deleted_count, failures
+
+# Function to get the child digests of manifest lists, from their manifests; lists that could not be read are left out
+def get_manifest_children(repository_name, digests):
+    children = {}
+    for i in range(0, len(digests), GET_IMAGE_BATCH_SIZE):
+        response = ecr_client.batch_get_image(
+            repositoryName=repository_name,
+            imageIds=[{'imageDigest': digest} for digest in digests[i:i+GET_IMAGE_BATCH_SIZE]],
+            acceptedMediaTypes=list(MANIFEST_LIST_TYPES)
+        )
+        if response.get('failures'):
+            print(f"Could not read manifest lists in repository {repository_name}: {response['failures']}")
+        for image in response.get('images', []):
+            manifest = json.loads(image['imageManifest'])
+            children[image['imageId']['imageDigest']] = [child['digest'] for child in manifest.get('manifests', [])]
+    return children
+
+# Function to index a repository: digest -> tags, push and pull times and manifest list children
+def build_image_index(repository_name, images):
+    index = {}
+    manifest_lists = []
+    for img in images:
+        index[img['imageDigest']] = {
+            'tags': img.get('imageTags', []),
+            'pushed': img['imagePushedAt'],
+            'pulled': img.get('lastRecordedPullTime'),
+            'children': [],
+        }
+        if img.get('imageManifestMediaType') in MANIFEST_LIST_TYPES:
+            manifest_lists.append(img['imageDigest'])
+    children = get_manifest_children(repository_name, manifest_lists)
+    for digest, child_digests in children.items():
+        index[digest]['children'] = child_digests
+
+    # A manifest list that could not be read may own any untagged image, so all of them count as its children
+    unresolved = [digest for digest in manifest_lists if digest not in children]
+    if unresolved:
+        untagged = [digest for digest in index if not index[digest]['tags'] and digest not in manifest_lists]
+        print(f"Treating the {len(untagged)} untagged images of repository {repository_name} as children of "
+              f"{len(unresolved)} unreadable manifest lists")
+        for digest in unresolved:
+            index[digest]['children'] = untagged
+    return index
+
+# Function to evaluate the retention rules in one pass over the index, newest first; returns the digests to delete
+def select_images_to_delete(index, policy=RETENTION_POLICY):
+    now = datetime.now(timezone.utc)
+    cutoff_date = now - timedelta(days=RETENTION_PERIOD)
+    pull_cutoff = now - timedelta(days=policy['keep_pulled_days']) if policy.get('keep_pulled_days') else None
+    prefix_limits = policy.get('keep_last_per_tag_prefix', {})
+    prefix_counts = dict.fromkeys(prefix_limits, 0)
+
+    kept = set()
+    for position, digest in enumerate(sorted(index, key=lambda d: index[d]['pushed'], reverse=True)):
+        image = index[digest]
+        keep = position < MIN_IMG_KEPT or image['pushed'] >= cutoff_date
+        if pull_cutoff and image['pulled'] and image['pulled'] >= pull_cutoff:
+            keep = True
+        if policy.get('keep_semver') and any(SEMVER_TAG.match(tag) for tag in image['tags']):
+            keep = True
+        for prefix, limit in prefix_limits.items():
+            if any(tag.startswith(prefix) for tag in image['tags']):
+                prefix_counts[prefix] += 1
+                if prefix_counts[prefix] <= limit:
+                    keep = True
+        if keep:
+            kept.add(digest)
 
-# Function for cleaning up repositories
-def clean_up(repository_name):
+    # Never orphan the children of a kept manifest list
+    for digest in list(kept):
+        kept.update(index[digest]['children'])
+
+    # Manifest lists go first so their children are no longer referenced when they are deleted
+    return sorted((digest for digest in index if digest not in kept), key=lambda d: not index[d]['children'])
+
+# Function for cleaning up repositories, returns the per-repository result
+def clean_up(repository_name, dry_run=False, policy=RETENTION_POLICY):
+    started = time.perf_counter()
+    result = {'repository': repository_name, 'images': 0, 'to_delete': 0, 'deleted': 0, 'failures': [], 'seconds': 0.0}
     images = list_images(repository_name)
+    if images is None:
+        result['failures'].append({'failureReason': f"Could not list images in repository {repository_name}"})
+        result['seconds'] = time.perf_counter() - started
+        return result
+    result['images'] = len(images)
     if len(images) <= MIN_IMG_KEPT:
         print(f"Repository {repository_name} has {len(images)} images. So, no clean up needed")
-        return
-
-    cutoff_date = datetime.now(timezone.utc) - timedelta(days=RETENTION_PERIOD)
-    images_to_delete = [img for img in images if img['imagePushedAt'] < cutoff_date]
-
-    if len(images_to_delete) + MIN_IMG_KEPT > len(images):
-        images_to_delete = images_to_delete[:len(images) - MIN_IMG_KEPT]
+        result['seconds'] = time.perf_counter() - started
+        return result
 
-    image_ids_to_delete = [{'imageDigest': img['imageDigest']} for img in images_to_delete]
+    index = build_image_index(repository_name, images)
+    image_ids_to_delete = [{'imageDigest': digest} for digest in select_images_to_delete(index, policy)]
+    result['to_delete'] = len(image_ids_to_delete)
 
-    if image_ids_to_delete:
+    if image_ids_to_delete and dry_run:
+        print(f"Would delete {len(image_ids_to_delete)} images from repository {repository_name}.")
+    elif image_ids_to_delete:
         print(f"Preparing to delete {len(image_ids_to_delete)} images from repository {repository_name}.")
-        delete_images(repository_name, image_ids_to_delete)
+        result['deleted'], result['failures'] = delete_images(repository_name, image_ids_to_delete)
     else:
         print(f"No images to delete from repository {repository_name}.")
+    result['seconds'] = time.perf_counter() - started
+    return result
+
+# Function to clean up repositories concurrently with a bounded pool of workers
+def clean_up_repositories(repositories, max_workers=MAX_WORKERS, dry_run=False, policy=RETENTION_POLICY):
+    results = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(clean_up, repo, dry_run, policy): repo for repo in repositories}
+        for future in as_completed(futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                print(f"Exception Occurred while cleaning repository {futures[future]}: {e}")
+                results.append({'repository': futures[future], 'images': 0, 'to_delete': 0, 'deleted': 0,
+                                'failures': [{'failureReason': str(e)}], 'seconds': 0.0})
+    return results
 
 # Main function
 def main():
+    parser = argparse.ArgumentParser(description="Delete old images from every ECR repository")
+    parser.add_argument('--workers', type=int, default=MAX_WORKERS, help="Number of repositories cleaned concurrently")
+    parser.add_argument('--dry-run', action='store_true', help="Only report what would be deleted")
+    parser.add_argument('--no-keep-semver', action='store_true', help="Do not keep images just because they carry a semver tag")
+    parser.add_argument('--keep-last', action='append', default=[], metavar='PREFIX=N',
+                        help="Keep the newest N images whose tags start with PREFIX (repeatable)")
+    parser.add_argument('--keep-pulled-days', type=int, default=RETENTION_POLICY['keep_pulled_days'],
+                        help="Keep images pulled within this many days (0 disables the rule)")
+    args = parser.parse_args()
+
+    policy = {
+        'keep_semver': not args.no_keep_semver,
+        'keep_last_per_tag_prefix': {prefix: int(count) for prefix, count in (rule.rsplit('=', 1) for rule in args.keep_last)},
+        'keep_pulled_days': args.keep_pulled_days,
+    }
+
+    # One pooled connection per worker, so --workers above MAX_WORKERS does not queue on the pool
+    global ecr_client
+    ecr_client = create_ecr_client(max(args.workers, MAX_WORKERS))
+
+    started = time.perf_counter()
     repositories = list_ecr_repo()
     if not repositories:
         print("No ECR repositories found. Exiting...")
         return
-    for repo in repositories:
-        clean_up(repo)
+    results = clean_up_repositories(repositories, args.workers, args.dry_run, policy)
+
+    for result in sorted(results, key=lambda r: r['repository']):
+        if result['to_delete'] or result['failures']:
+            print(f"{result['repository']}: {result['images']} images, {result['deleted']}/{result['to_delete']} deleted, "
+                  f"{len(result['failures'])} failures in {result['seconds']:.1f}s")
+    print(f"Cleaned {len(results)} repositories: {sum(r['deleted'] for r in results)} images deleted, "
+          f"{sum(len(r['failures']) for r in results)} failures in {time.perf_counter() - started:.1f}s")
 
 # Main execution
 if __name__ == '__main__':
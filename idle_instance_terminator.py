@@ -1,6 +1,13 @@
+import argparse
 import boto3
+import json
 import logging
-from datetime import datetime, timedelta
+import time
+import botocore.session
+from botocore.credentials import RefreshableCredentials
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
@@ -8,91 +15,388 @@ logging.basicConfig(level=logging.INFO)
 # Constants
 IDLE_THRESHOLD_CPU = 5.0  # CPU utilization threshold to consider an instance as idle
 IDLE_THRESHOLD_NETWORK = 1000  # Network utilization threshold to consider an instance as idle
+IDLE_WINDOW_MINUTES = 15  # Lookback window used to judge utilization
+METRIC_PERIOD = 300
+MAX_METRIC_QUERIES = 500  # get_metric_data accepts at most 500 queries per call
+FILTER_BATCH_SIZE = 200  # Values per describe_* filter or id list
+TERMINATE_BATCH_SIZE = 100  # Instances per terminate_instances call
+SNAPSHOT_WORKERS = 16  # Concurrent create_snapshot calls
+SNAPSHOT_POLL_SECONDS = 15
+SNAPSHOT_TIMEOUT_SECONDS = 3600  # Instances whose snapshots are not done by then are left running
+FLEET_WORKERS = 16  # Regions swept concurrently
+UNDERUTILIZED_THRESHOLD_CPU = 20.0  # p95 CPU below this is reported as underutilized
+MIN_IDLE_HOURS = 24  # An instance must have been idle this long, up to now, to be classified idle
+MIN_IDLE_POINTS = MIN_IDLE_HOURS * 3600 // METRIC_PERIOD  # Reported datapoints required before an instance can be idle
+MAX_REPORTING_LAG_POINTS = 2  # Latest periods CloudWatch may not have published yet
+FLEET_REPORT_FILE = 'idle_fleet_report.json'
 
 # Initialize AWS clients
 ec2 = boto3.client('ec2')
 cloudwatch = boto3.client('cloudwatch')
 
-def evaluate_instance(instance_id):
-    end_time = datetime.utcnow()
-    start_time = end_time - timedelta(minutes=15)
-    
-    # Fetch CPU utilization
-    cpu_response = cloudwatch.get_metric_statistics(
-        MetricName='CPUUtilization',
-        Namespace='AWS/EC2',
-        Statistics=['Average'],
-        StartTime=start_time,
-        EndTime=end_time,
-        Period=300,
-        Dimensions=[
-            {
-                'Name': 'InstanceId',
-                'Value': instance_id
-            },
-        ]
-    )
-    
-    cpu_data = cpu_response['Datapoints']
-    cpu_utilization = cpu_data[0]['Average'] if cpu_data else 0
-    
-    # Fetch network utilization
-    network_response = cloudwatch.get_metric_statistics(
-        MetricName='NetworkIn',
-        Namespace='AWS/EC2',
-        Statistics=['Sum'],
-        StartTime=start_time,
-        EndTime=end_time,
-        Period=300,
-        Dimensions=[
-            {
-                'Name': 'InstanceId',
-                'Value': instance_id
+def metric_query(query_id, instance_id, metric_name, stat):
+    return {
+        'Id': query_id,
+        'MetricStat': {
+            'Metric': {
+                'Namespace': 'AWS/EC2',
+                'MetricName': metric_name,
+                'Dimensions': [{'Name': 'InstanceId', 'Value': instance_id}]
             },
-        ]
+            'Period': METRIC_PERIOD,
+            'Stat': stat
+        },
+        'ReturnData': True
+    }
+
+def collect_utilization(instance_ids, cloudwatch_client=cloudwatch):
+    # CPU and network queries for the whole fleet, packed 500 per get_metric_data call
+    end_time = datetime.utcnow()
+    start_time = end_time - timedelta(minutes=IDLE_WINDOW_MINUTES)
+
+    queries = []
+    for index, instance_id in enumerate(instance_ids):
+        queries.append(metric_query(f"cpu_{index}", instance_id, 'CPUUtilization', 'Average'))
+        queries.append(metric_query(f"net_{index}", instance_id, 'NetworkIn', 'Sum'))
+
+    latest = {}
+    for i in range(0, len(queries), MAX_METRIC_QUERIES):
+        batch = queries[i:i + MAX_METRIC_QUERIES]
+        next_token = None
+        while True:
+            params = {'MetricDataQueries': batch, 'StartTime': start_time, 'EndTime': end_time}
+            if next_token:
+                params['NextToken'] = next_token
+            response = cloudwatch_client.get_metric_data(**params)
+            for result in response['MetricDataResults']:
+                # Values are returned newest first; keep the latest datapoint of each query
+                if result['Values'] and result['Id'] not in latest:
+                    latest[result['Id']] = result['Values'][0]
+            next_token = response.get('NextToken')
+            if not next_token:
+                break
+
+    return {
+        instance_id: (latest.get(f"cpu_{index}", 0), latest.get(f"net_{index}", 0))
+        for index, instance_id in enumerate(instance_ids)
+    }
+
+def collect_series(instance_ids, lookback_days, cloudwatch_client=cloudwatch):
+    # Returns CPU and NetworkIn as instances x timestamps arrays (NaN where no datapoint was reported)
+    import numpy as np  # optional dependency, only needed with --lookback-days
+    period_seconds = METRIC_PERIOD
+    end_ts = datetime.now(timezone.utc).timestamp() // period_seconds * period_seconds
+    start_ts = end_ts - lookback_days * 86400
+    points = int((end_ts - start_ts) // period_seconds)
+    series = {
+        'cpu': np.full((len(instance_ids), points), np.nan, dtype=np.float32),
+        'net': np.full((len(instance_ids), points), np.nan, dtype=np.float32),
+    }
+
+    queries = []
+    for index, instance_id in enumerate(instance_ids):
+        queries.append(metric_query(f"cpu_{index}", instance_id, 'CPUUtilization', 'Average'))
+        queries.append(metric_query(f"net_{index}", instance_id, 'NetworkIn', 'Sum'))
+
+    for i in range(0, len(queries), MAX_METRIC_QUERIES):
+        batch = queries[i:i + MAX_METRIC_QUERIES]
+        next_token = None
+        while True:
+            params = {
+                'MetricDataQueries': batch,
+                'StartTime': datetime.fromtimestamp(start_ts, timezone.utc),
+                'EndTime': datetime.fromtimestamp(end_ts, timezone.utc),
+            }
+            if next_token:
+                params['NextToken'] = next_token
+            response = cloudwatch_client.get_metric_data(**params)
+            for result in response['MetricDataResults']:
+                if not result['Values']:
+                    continue
+                metric, index = result['Id'].split('_')
+                timestamps = np.array([timestamp.timestamp() for timestamp in result['Timestamps']])
+                columns = ((timestamps - start_ts) // period_seconds).astype(np.int64)
+                valid = (columns >= 0) & (columns < points)
+                series[metric][int(index), columns[valid]] = np.asarray(result['Values'])[valid]
+            next_token = response.get('NextToken')
+            if not next_token:
+                break
+
+    return series['cpu'], series['net']
+
+def classify_utilization(cpu, net):
+    # Missing datapoints (before launch, or gaps in reporting) are never counted as idle
+    import numpy as np  # optional dependency, only needed with --lookback-days
+    valid = ~np.isnan(cpu)
+    valid_points = valid.sum(axis=1)
+    points = cpu.shape[1]
+    reported = valid_points > 0
+
+    # p95 over the reported points only: NaN sorts last, so each row's valid points come first
+    sorted_cpu = np.sort(cpu, axis=1)
+    rank = 0.95 * np.maximum(valid_points - 1, 0)
+    below = np.floor(rank).astype(np.int64)
+    above = np.minimum(below + 1, np.maximum(valid_points - 1, 0))
+    rows = np.arange(cpu.shape[0])
+    low, high = sorted_cpu[rows, below], sorted_cpu[rows, above]
+    p95_cpu = np.where(reported, low + (high - low) * (rank - below), np.nan)
+    total_network = np.nansum(net, axis=1)
+    network_points = np.maximum((~np.isnan(net)).sum(axis=1), 1)
+
+    # Idle streak: consecutive idle points back from the latest reported point to the last busy or missing one
+    with np.errstate(invalid='ignore'):
+        idle = valid & (cpu < IDLE_THRESHOLD_CPU) & ~(net >= IDLE_THRESHOLD_NETWORK)
+    positions = np.arange(points)
+    lag = np.where(reported, valid[:, ::-1].argmax(axis=1), points)
+    busy_reversed = ~idle[:, ::-1] & (positions >= lag[:, None])
+    streak = np.where(busy_reversed.any(axis=1), busy_reversed.argmax(axis=1), points) - lag
+    streak[lag > MAX_REPORTING_LAG_POINTS] = 0
+    idle_hours = streak * METRIC_PERIOD / 3600
+
+    classes = np.select(
+        [
+            (valid_points >= MIN_IDLE_POINTS) & (p95_cpu < IDLE_THRESHOLD_CPU)
+            & (total_network / network_points < IDLE_THRESHOLD_NETWORK) & (idle_hours >= MIN_IDLE_HOURS),
+            p95_cpu < UNDERUTILIZED_THRESHOLD_CPU,
+        ],
+        ['idle', 'underutilized'],
+        default='active',
     )
-    
-    network_data = network_response['Datapoints']
-    network_utilization = network_data[0]['Sum'] if network_data else 0
-    
-    return cpu_utilization, network_utilization
+    return p95_cpu, total_network, idle_hours, classes
+
+def evaluate_fleet(instance_ids, lookback_days, cloudwatch_client=cloudwatch):
+    cpu, net = collect_series(instance_ids, lookback_days, cloudwatch_client)
+    p95_cpu, total_network, idle_hours, classes = classify_utilization(cpu, net)
+    idle_instances = []
+    for index, instance_id in enumerate(instance_ids):
+        logging.info(f"Instance {instance_id} is {classes[index]}: p95 CPU {p95_cpu[index]:.2f}%, "
+                     f"Network {total_network[index]:.0f} bytes, idle for {idle_hours[index]:.1f} hours")
+        if classes[index] == 'idle':
+            idle_instances.append(instance_id)
+    return idle_instances
+
+def evaluate_instance(instance_id):
+    return collect_utilization([instance_id])[instance_id]
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def find_idle_instances(instance_ids, utilization):
+    idle_instances = []
+    for instance_id in instance_ids:
+        cpu_utilization, network_utilization = utilization[instance_id]
+        if cpu_utilization < IDLE_THRESHOLD_CPU and network_utilization < IDLE_THRESHOLD_NETWORK:
+            logging.info(f"Instance {instance_id} has low utilization: CPU {cpu_utilization:.2f}%, Network {network_utilization:.2f} bytes")
+            idle_instances.append(instance_id)
+        else:
+            logging.info(f"Instance {instance_id} is adequately utilized: CPU {cpu_utilization:.2f}%, Network {network_utilization:.2f} bytes")
+    return idle_instances
+
+def fetch_volumes(instance_ids, ec2_client=ec2):
+    # One filtered, paginated describe_volumes per 200 instances instead of one call per instance
+    volumes_by_instance = {instance_id: [] for instance_id in instance_ids}
+    paginator = ec2_client.get_paginator('describe_volumes')
+    for batch in chunks(instance_ids, FILTER_BATCH_SIZE):
+        for page in paginator.paginate(Filters=[{'Name': 'attachment.instance-id', 'Values': batch}]):
+            for volume in page['Volumes']:
+                for attachment in volume['Attachments']:
+                    if attachment['InstanceId'] in volumes_by_instance:
+                        volumes_by_instance[attachment['InstanceId']].append(volume['VolumeId'])
+    return volumes_by_instance
+
+def snapshot_volume(instance_id, volume_id, ec2_client=ec2):
+    try:
+        snapshot = ec2_client.create_snapshot(VolumeId=volume_id, Description=f"Snapshot of {volume_id} before termination")
+        logging.info(f"Snapshot created for volume {volume_id} of instance {instance_id} (Snapshot ID: {snapshot['SnapshotId']})")
+        return snapshot['SnapshotId']
+    except Exception as e:
+        logging.error(f"Failed to create snapshot for volume {volume_id} of instance {instance_id}: {e}")
+        return None
+
+def create_snapshots(volumes_by_instance, ec2_client=ec2):
+    jobs = [(instance_id, volume_id) for instance_id, volume_ids in volumes_by_instance.items() for volume_id in volume_ids]
+    snapshots_by_instance = {instance_id: [] for instance_id in volumes_by_instance}
+    failed_instances = set()
+    with ThreadPoolExecutor(max_workers=SNAPSHOT_WORKERS) as executor:
+        for (instance_id, _), snapshot_id in zip(jobs, executor.map(lambda job: snapshot_volume(*job, ec2_client), jobs)):
+            if snapshot_id:
+                snapshots_by_instance[instance_id].append(snapshot_id)
+            else:
+                failed_instances.add(instance_id)
+    return snapshots_by_instance, failed_instances
+
+def wait_for_snapshots(snapshot_ids, ec2_client=ec2):
+    # Polls the pending snapshots in batches; returns the ids that completed
+    pending = set(snapshot_ids)
+    completed = set()
+    deadline = time.monotonic() + SNAPSHOT_TIMEOUT_SECONDS
+    while pending and time.monotonic() < deadline:
+        for batch in chunks(sorted(pending), FILTER_BATCH_SIZE):
+            try:
+                response = ec2_client.describe_snapshots(SnapshotIds=batch)
+            except ClientError as e:
+                # A snapshot just created may not be visible yet; the whole batch stays pending until the deadline
+                if e.response['Error']['Code'] != 'InvalidSnapshot.NotFound':
+                    logging.error(f"Failed to describe {len(batch)} snapshots: {e}")
+                continue
+            for snapshot in response['Snapshots']:
+                if snapshot['State'] == 'completed':
+                    completed.add(snapshot['SnapshotId'])
+                    pending.discard(snapshot['SnapshotId'])
+                elif snapshot['State'] == 'error':
+                    logging.error(f"Snapshot {snapshot['SnapshotId']} failed")
+                    pending.discard(snapshot['SnapshotId'])
+        if pending:
+            logging.info(f"Waiting for {len(pending)} snapshots to complete...")
+            time.sleep(SNAPSHOT_POLL_SECONDS)
+    return completed
+
+def terminate_batch(instance_ids, ec2_client=ec2):
+    # TerminateInstances rejects the whole call when one instance fails, so a failed batch is retried one by one
+    try:
+        response = ec2_client.terminate_instances(InstanceIds=instance_ids)
+        return {instance['InstanceId']: instance['CurrentState']['Name'] for instance in response['TerminatingInstances']}
+    except ClientError as e:
+        if len(instance_ids) == 1:
+            logging.error(f"Failed to terminate instance {instance_ids[0]}: {e}")
+            return {}
+        logging.warning(f"Batch termination of {len(instance_ids)} instances failed ({e}), retrying them one by one")
+        terminating = {}
+        for instance_id in instance_ids:
+            terminating.update(terminate_batch([instance_id], ec2_client))
+        return terminating
+
+def terminate_instances(instance_ids, ec2_client=ec2):
+    # Returns the instances whose termination was accepted
+    terminated = []
+    for batch in chunks(instance_ids, TERMINATE_BATCH_SIZE):
+        terminating = terminate_batch(batch, ec2_client)
+        for instance_id in batch:
+            # Ensure termination was requested
+            if terminating.get(instance_id) in ('shutting-down', 'terminated'):
+                logging.info(f"Instance {instance_id} is being terminated.")
+                terminated.append(instance_id)
+            else:
+                logging.warning(f"Instance {instance_id} was not successfully terminated.")
+    return terminated
+
+def list_running_instances(ec2_client=ec2):
+    paginator = ec2_client.get_paginator('describe_instances')
+    instance_ids = []
+    for page in paginator.paginate(Filters=[{'Name': 'instance-state-name', 'Values': ['running']}]):
+        for reservation in page['Reservations']:
+            for instance in reservation['Instances']:
+                instance_ids.append(instance['InstanceId'])
+    return instance_ids
+
+def terminate_idle_instances(idle_instances, ec2_client=ec2):
+    # Snapshot every volume of the idle instances, then terminate those whose snapshots completed
+    volumes_by_instance = fetch_volumes(idle_instances, ec2_client)
+    snapshots_by_instance, failed_instances = create_snapshots(volumes_by_instance, ec2_client)
+    completed = wait_for_snapshots([snapshot_id for snapshot_ids in snapshots_by_instance.values() for snapshot_id in snapshot_ids], ec2_client)
+    ready_instances = []
+    for instance_id in idle_instances:
+        if instance_id in failed_instances or not completed.issuperset(snapshots_by_instance[instance_id]):
+            logging.warning(f"Skipping termination of instance {instance_id}: its snapshots did not complete.")
+        else:
+            ready_instances.append(instance_id)
+
+    if ready_instances:
+        logging.info(f"Terminating {len(ready_instances)} idle instances...")
+        return terminate_instances(ready_instances, ec2_client)
+    return ready_instances
+
+def account_sessions(accounts_file=None):
+    # Yields (account label, session); the config file lists roles to assume as [{"name": ..., "role_arn": ...}]
+    yield 'default', boto3.Session()
+    if not accounts_file:
+        return
+    with open(accounts_file) as file:
+        accounts = json.load(file)
+    sts = boto3.client('sts')
+    for account in accounts:
+        yield account.get('name', account['role_arn']), assumed_role_session(sts, account['role_arn'])
+
+def assumed_role_session(sts_client, role_arn):
+    # The role is assumed again whenever the credentials near expiry, so a sweep waiting on snapshots
+    # for longer than the role's session duration can still terminate afterwards
+    def assume_role():
+        credentials = sts_client.assume_role(RoleArn=role_arn, RoleSessionName='idle-instance-terminator')['Credentials']
+        return {
+            'access_key': credentials['AccessKeyId'],
+            'secret_key': credentials['SecretAccessKey'],
+            'token': credentials['SessionToken'],
+            'expiry_time': credentials['Expiration'].isoformat(),
+        }
+
+    session = botocore.session.get_session()
+    session._credentials = RefreshableCredentials.create_from_metadata(
+        metadata=assume_role(), refresh_using=assume_role, method='sts-assume-role')
+    return boto3.Session(botocore_session=session)
+
+def sweep_region(account, region, ec2_client, cloudwatch_client, terminate=False, lookback_days=None):
+    started = time.monotonic()
+    report = {'account': account, 'region': region}
+    try:
+        instance_ids = list_running_instances(ec2_client)
+        if lookback_days:
+            idle_instances = evaluate_fleet(instance_ids, lookback_days, cloudwatch_client)
+        else:
+            idle_instances = find_idle_instances(instance_ids, collect_utilization(instance_ids, cloudwatch_client))
+        report.update({'running_instances': len(instance_ids), 'idle_instances': idle_instances})
+        if terminate and idle_instances:
+            report['terminated_instances'] = terminate_idle_instances(idle_instances, ec2_client)
+    except Exception as e:
+        logging.error(f"Sweep of {account}/{region} failed: {e}")
+        report['error'] = str(e)
+    report['seconds'] = round(time.monotonic() - started, 2)
+    logging.info(f"Swept {account}/{region} in {report['seconds']}s")
+    return report
+
+def sweep_fleet(regions=None, accounts_file=None, terminate=False, lookback_days=None):
+    # Every (account, region) pair runs on one shared pool, so wall-clock time tracks the slowest region.
+    # Sessions are not thread-safe, so the clients are created here and handed to the workers.
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=FLEET_WORKERS) as executor:
+        futures = []
+        for account, session in account_sessions(accounts_file):
+            account_regions = regions or [region['RegionName'] for region in session.client('ec2').describe_regions()['Regions']]
+            for region in account_regions:
+                ec2_client = session.client('ec2', region_name=region)
+                cloudwatch_client = session.client('cloudwatch', region_name=region)
+                futures.append(executor.submit(sweep_region, account, region, ec2_client, cloudwatch_client, terminate, lookback_days))
+        reports = [future.result() for future in futures]
+    return {'seconds': round(time.monotonic() - started, 2), 'regions': reports}
 
 def main():
+    parser = argparse.ArgumentParser(description="Snapshot and terminate idle EC2 instances")
+    parser.add_argument('--fleet', action='store_true', help="Evaluate every region (and account) concurrently and write a report")
+    parser.add_argument('--regions', nargs='+', help="Regions swept in fleet mode (defaults to all enabled regions)")
+    parser.add_argument('--accounts', help="JSON file of roles to assume in fleet mode")
+    parser.add_argument('--terminate', action='store_true', help="In fleet mode, also snapshot and terminate the idle instances")
+    parser.add_argument('--report', default=FLEET_REPORT_FILE, help="Path of the fleet report")
+    parser.add_argument('--lookback-days', type=float, help="Classify instances from p95 CPU, network and idle streak over this many days")
+    args = parser.parse_args()
+
+    if args.fleet:
+        report = sweep_fleet(args.regions, args.accounts, args.terminate, args.lookback_days)
+        with open(args.report, mode='w') as file:
+            json.dump(report, file, indent=2)
+        logging.info(f"Fleet swept in {report['seconds']}s, report written to {args.report}")
+        return
+
     logging.info("Fetching the list of running instances...")
-    instances = ec2.describe_instances(
-        Filters=[{'Name': 'instance-state-name', 'Values': ['running']}]
-    )
-    
-    for reservation in instances['Reservations']:
-        for instance in reservation['Instances']:
-            instance_id = instance['InstanceId']
-            logging.info(f"Evaluating instance {instance_id} for utilization...")
-            cpu_utilization, network_utilization = evaluate_instance(instance_id)
-            
-            logging.info(f"CPU Utilization: {cpu_utilization:.2f}%")
-            logging.info(f"Network Utilization: {network_utilization:.2f} bytes")
-            
-            if cpu_utilization < IDLE_THRESHOLD_CPU and network_utilization < IDLE_THRESHOLD_NETWORK:
-                logging.info(f"Instance {instance_id} has low utilization: CPU {cpu_utilization:.2f}%, Network {network_utilization:.2f} bytes")
-                
-                # Create snapshot for the instance's volumes
-                volumes = ec2.describe_volumes(Filters=[{'Name': 'attachment.instance-id', 'Values': [instance_id]}])
-                for volume in volumes['Volumes']:
-                    volume_id = volume['VolumeId']
-                    snapshot = ec2.create_snapshot(VolumeId=volume_id, Description=f"Snapshot of {volume_id} before termination")
-                    logging.info(f"Snapshot created for volume {volume_id} of instance {instance_id} (Snapshot ID: {snapshot['SnapshotId']})")
-                
-                # Terminate the instance
-                termination_response = ec2.terminate_instances(InstanceIds=[instance_id])
-                logging.info(f"Termination response for instance {instance_id}: {termination_response}")
-                
-                # Ensure termination was requested
-                if termination_response['TerminatingInstances'][0]['CurrentState']['Name'] == 'shutting-down':
-                    logging.info(f"Instance {instance_id} is being terminated.")
-                else:
-                    logging.warning(f"Instance {instance_id} was not successfully terminated.")
-            else:
-                logging.info(f"Instance {instance_id} is adequately utilized: CPU {cpu_utilization:.2f}%, Network {network_utilization:.2f} bytes")
+    instance_ids = list_running_instances()
+    logging.info(f"Collecting utilization of {len(instance_ids)} instances...")
+    if args.lookback_days:
+        idle_instances = evaluate_fleet(instance_ids, args.lookback_days)
+    else:
+        idle_instances = find_idle_instances(instance_ids, collect_utilization(instance_ids))
+    if not idle_instances:
+        logging.info("No idle instances found.")
+        return
+    terminate_idle_instances(idle_instances)
 
 if __name__ == "__main__":
     main()
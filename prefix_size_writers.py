@@ -0,0 +1,79 @@
+#author: Vijay Sankar C
+#description: Output writers shared by the prefix size scripts. CSV is the default; Parquet and Arrow IPC are written in record batches and need pyarrow.
+
+#import section
+import csv
+
+#define constants
+OUTPUT_FORMATS = ('csv', 'parquet', 'arrow')
+BATCH_SIZE = 65536  # Rows buffered per record batch
+
+#csv writer
+class CsvWriter:
+    def __init__(self, output_file, columns):
+        self.file = open(output_file, mode='w', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow([name for name, _ in columns])
+
+    def write_rows(self, rows):
+        self.writer.writerows(rows)
+
+    def write_batch(self, batch):
+        self.writer.writerows(zip(*(column.to_pylist() for column in batch.columns)))
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+#parquet / arrow ipc writer
+class ArrowWriter:
+    def __init__(self, output_file, columns, output_format, batch_size=BATCH_SIZE):
+        import pyarrow as pa
+        self.pa = pa
+        self.schema = pa.schema([(name, getattr(pa, type_name)()) for name, type_name in columns])
+        self.batch_size = batch_size
+        self.buffer = []
+        if output_format == 'parquet':
+            import pyarrow.parquet as pq
+            self.writer = pq.ParquetWriter(output_file, self.schema)
+        else:
+            self.writer = pa.ipc.new_file(output_file, self.schema)
+
+    def write_rows(self, rows):
+        for row in rows:
+            self.buffer.append(row)
+            if len(self.buffer) >= self.batch_size:
+                self.flush()
+
+    def write_batch(self, batch):
+        self.flush()
+        self.writer.write_batch(batch)
+
+    def flush(self):
+        if self.buffer:
+            arrays = [self.pa.array(values, type=field.type) for values, field in zip(zip(*self.buffer), self.schema)]
+            self.writer.write_batch(self.pa.record_batch(arrays, schema=self.schema))
+            self.buffer = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+#def function for opening a writer; columns are (name, pyarrow type name) pairs
+def open_writer(output_file, columns, output_format='csv'):
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Invalid output format. Choose from {', '.join(OUTPUT_FORMATS)}.")
+    if output_format == 'csv':
+        return CsvWriter(output_file, columns)
+    return ArrowWriter(output_file, columns, output_format)
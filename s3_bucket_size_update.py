@@ -5,49 +5,485 @@
 #import section
 import boto3
 from botocore.exceptions import ClientError
-from collections import defaultdict
+from array import array
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import unquote_plus
+import argparse
 import csv
+import gzip
+import hashlib
+import io
+import json
+import os
+import sqlite3
+from prefix_size_writers import OUTPUT_FORMATS, open_writer
 
 #init client
 s3_client = boto3.client('s3')
+sqs_client = boto3.client('sqs')
+
+#define constants
+MAX_WORKERS = 16  # Number of shards listed concurrently
+MAX_SHARDS_PER_PREFIX = 8  # Upper bound on key-range splits of a single top-level prefix
+MAX_SAMPLE_PROBES = 256  # list_objects_v2 probes spent on splitting one prefix
+MAX_SAMPLE_DEPTH = 64  # Characters descended while looking for enough key-range boundaries
+MAX_KEY_CHARACTER = '\U0010ffff'  # Sorts after every other character (S3 lists keys in UTF-8 byte order)
+DEFAULT_DEPTH = 1  # Number of prefix levels aggregated in one listing pass
+PARQUET_BATCH_SIZE = 65536  # Rows decoded per Parquet record batch
+
+#prefix trie holding byte and object counts at every level up to a fixed depth
+class PrefixTrie:
+    def __init__(self, depth=DEFAULT_DEPTH):
+        self.depth = depth
+        self.segments = []        # interned path segments, indexed by segment id
+        self.segment_ids = {}
+        self.children = {}       # (parent node id << 32 | segment id) -> node id
+        self.parent = array('l')  # node id -> parent node id (-1 for top-level nodes)
+        self.segment = array('l')
+        self.level = array('b')
+        self.size = array('q')
+        self.count = array('q')
+
+    def _node(self, parent, segment):
+        segment_id = self.segment_ids.get(segment)
+        if segment_id is None:
+            segment_id = self.segment_ids[segment] = len(self.segments)
+            self.segments.append(segment)
+        child_key = (parent + 1) << 32 | segment_id
+        node = self.children.get(child_key)
+        if node is None:
+            node = self.children[child_key] = len(self.size)
+            self.parent.append(parent)
+            self.segment.append(segment_id)
+            self.level.append(self.level[parent] + 1 if parent >= 0 else 1)
+            self.size.append(0)
+            self.count.append(0)
+        return node
+
+    def add(self, key, size, count=1):
+        node = -1
+        for segment in key.split('/', self.depth)[:self.depth]:
+            # A leading '/' is recorded under the '' prefix; later empty segments (trailing or '//') end the path
+            if not segment and node >= 0:
+                break
+            node = self._node(node, segment)
+            self.size[node] += size
+            self.count[node] += count
+
+    def merge(self, other):
+        # Nodes are created parent-first, so a single pass in id order can remap parents
+        mapping = array('l', [0]) * len(other.size)
+        for node in range(len(other.size)):
+            parent = other.parent[node]
+            mine = self._node(mapping[parent] if parent >= 0 else -1, other.segments[other.segment[node]])
+            mapping[node] = mine
+            self.size[mine] += other.size[node]
+            self.count[mine] += other.count[node]
+
+    def path(self, node):
+        segments = []
+        while node >= 0:
+            segments.append(self.segments[self.segment[node]])
+            node = self.parent[node]
+        return '/'.join(reversed(segments))
+
+    def rows(self, level=1):
+        # Keys with fewer than `level` segments are reported at their own (shallower) path
+        child_size = array('q', [0]) * len(self.size)
+        child_count = array('q', [0]) * len(self.size)
+        for node in range(len(self.size)):
+            parent = self.parent[node]
+            if parent >= 0 and self.level[node] <= level:
+                child_size[parent] += self.size[node]
+                child_count[parent] += self.count[node]
+        for node in range(len(self.size)):
+            if self.level[node] == level:
+                yield self.path(node), self.size[node], self.count[node]
+            elif self.level[node] < level and self.count[node] > child_count[node]:
+                yield self.path(node), self.size[node] - child_size[node], self.count[node] - child_count[node]
+
+    def sizes(self, level=1):
+        return {prefix: size for prefix, size, _ in self.rows(level)}
+
+#def function for discovering top-level prefixes and root-level objects
+def discover_top_level_prefixes(bucket_name, trie):
+    prefixes = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Delimiter='/'):
+        for common_prefix in page.get('CommonPrefixes', []):
+            prefixes.append(common_prefix['Prefix'])
+        for obj in page.get('Contents', []):
+            trie.add(obj['Key'], obj['Size'])
+    return prefixes
+
+#def function for listing the distinct characters that follow `base` in the keys, without listing the keys
+def next_characters(bucket_name, base, max_probes):
+    # Skip scan: each MaxKeys=1 probe returns the first key of the next non-empty character bucket
+    characters = []
+    start_after = base
+    while len(characters) < max_probes:
+        response = s3_client.list_objects_v2(Bucket=bucket_name, Prefix=base, StartAfter=start_after, MaxKeys=1)
+        contents = response.get('Contents', [])
+        if not contents:
+            break
+        character = contents[0]['Key'][len(base)]
+        characters.append(character)
+        start_after = base + character + MAX_KEY_CHARACTER
+    return characters
+
+#def function for sampling key-range boundaries of a large prefix
+def sample_boundaries(bucket_name, prefix):
+    # Buckets of keys sharing a leading string are split one character deeper until there are enough of them
+    buckets = [prefix]
+    probes = MAX_SAMPLE_PROBES
+    for _ in range(MAX_SAMPLE_DEPTH):
+        if len(buckets) >= MAX_SHARDS_PER_PREFIX or probes <= 0:
+            break
+        expanded = []
+        for base in buckets:
+            characters = next_characters(bucket_name, base, probes) if probes > 0 else []
+            probes -= len(characters) + 1
+            if characters:
+                expanded.extend(base + character for character in characters)
+            else:
+                expanded.append(base)
+        if expanded == buckets:
+            break
+        buckets = expanded
+    # Keys of a bucket sort at or below its leading string followed by the highest code point
+    return [base + MAX_KEY_CHARACTER for base in buckets[:-1]]
+
+#def function for splitting a top-level prefix into key ranges
+def plan_shards(bucket_name, prefix):
+    # A prefix that fits in one page is a single shard; larger ones are cut where their keys diverge.
+    # Shards cover (start_after, end_at], so a flat prefix with millions of keys is split too.
+    response = s3_client.list_objects_v2(Bucket=bucket_name, Prefix=prefix)
+    boundaries = sample_boundaries(bucket_name, prefix) if response.get('IsTruncated') else []
+    if not boundaries:
+        return [(prefix, None, None)]
+
+    step = -(-(len(boundaries) + 1) // MAX_SHARDS_PER_PREFIX)  # ceiling division
+    cuts = boundaries[step - 1::step]
+    shards = []
+    start_after = None
+    for end_at in cuts:
+        shards.append((prefix, start_after, end_at))
+        start_after = end_at
+    shards.append((prefix, start_after, None))
+    return shards
+
+#def function for calculating the size of one shard
+def scan_shard(bucket_name, prefix, start_after=None, end_at=None, depth=DEFAULT_DEPTH, digest=None):
+    shard_trie = PrefixTrie(depth)
+    params = {'Bucket': bucket_name, 'Prefix': prefix}
+    if start_after:
+        params['StartAfter'] = start_after
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(**params):
+        for obj in page.get('Contents', []):
+            key = obj['Key']
+            if end_at is not None and key > end_at:
+                return shard_trie
+            shard_trie.add(key, obj['Size'])
+            if digest is not None:
+                digest.update(f"{key}\0{obj.get('ETag')}\0{obj['Size']}\0{obj.get('LastModified')}\n".encode())
+    return shard_trie
+
+#def function for building the prefix trie of a bucket in one listing pass
+def calculate_prefix_trie(bucket_name, max_workers=MAX_WORKERS, depth=DEFAULT_DEPTH):
+    try:
+        trie = PrefixTrie(depth)
+        prefixes = discover_top_level_prefixes(bucket_name, trie)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            shards = [shard for shard_list in executor.map(lambda p: plan_shards(bucket_name, p), prefixes)
+                      for shard in shard_list]
+            for shard_trie in executor.map(lambda s: scan_shard(bucket_name, *s, depth=depth), shards):
+                trie.merge(shard_trie)
+        return trie
+    except ClientError as e:
+        print(f"API Error Occurred: {e}")
+        return None
+    except Exception as e:
+        print(f"Error Occurred: {e}")
+        return None
 
 #def function for calculating prefix size
-def calculate_prefix_size(bucket_name):
+def calculate_prefix_size(bucket_name, max_workers=MAX_WORKERS):
+    trie = calculate_prefix_trie(bucket_name, max_workers)
+    return trie.sizes(1) if trie else {}  # Return an empty dictionary on errors
+
+#def function for draining S3 event notifications into the set of changed keys
+def drain_change_events(queue_url, bucket_name):
+    changed_keys = set()
+    receipt_handles = []
+    while True:
+        response = sqs_client.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10, WaitTimeSeconds=1)
+        messages = response.get('Messages', [])
+        if not messages:
+            return changed_keys, receipt_handles
+        for message in messages:
+            receipt_handles.append(message['ReceiptHandle'])
+            for record in json.loads(message['Body']).get('Records', []):
+                if record['s3']['bucket']['name'] == bucket_name:
+                    changed_keys.add(unquote_plus(record['s3']['object']['key']))
+
+#def function for acknowledging S3 event notifications once the checkpoint is saved
+def delete_change_events(queue_url, receipt_handles):
+    for i in range(0, len(receipt_handles), 10):
+        batch = receipt_handles[i:i+10]
+        sqs_client.delete_message_batch(
+            QueueUrl=queue_url,
+            Entries=[{'Id': str(n), 'ReceiptHandle': handle} for n, handle in enumerate(batch)]
+        )
+
+#def function for opening the checkpoint store
+def open_checkpoint(checkpoint_file):
+    conn = sqlite3.connect(checkpoint_file)
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS meta (bucket TEXT, depth INTEGER);
+        CREATE TABLE IF NOT EXISTS shards (id INTEGER PRIMARY KEY, prefix TEXT, start_after TEXT, end_at TEXT, digest TEXT);
+        CREATE TABLE IF NOT EXISTS shard_rows (shard_id INTEGER, path TEXT, size INTEGER, count INTEGER);
+        CREATE INDEX IF NOT EXISTS shard_rows_shard ON shard_rows (shard_id);
+    """)
+    return conn
+
+#def function for listing one checkpointed shard; the root shard ('') holds the root-level objects
+def scan_checkpoint_shard(bucket_name, shard, depth):
+    prefix, start_after, end_at = shard
+    digest = hashlib.sha1()
+    if prefix:
+        shard_trie = scan_shard(bucket_name, prefix, start_after, end_at, depth, digest)
+        return shard_trie, digest.hexdigest(), None
+    shard_trie = PrefixTrie(depth)
+    prefixes = discover_top_level_prefixes(bucket_name, shard_trie)
+    for path, size, count in shard_trie.rows(depth):
+        digest.update(f"{path}\0{size}\0{count}\n".encode())
+    return shard_trie, digest.hexdigest(), prefixes
+
+#def function for finding the checkpointed shard that owns a key
+def owning_shard(shard_index, key):
+    if '/' not in key:
+        return ('', None, None)
+    for shard in shard_index.get(key.split('/')[0] + '/', []):
+        _, start_after, end_at = shard
+        if (start_after is None or key > start_after) and (end_at is None or key <= end_at):
+            return shard
+    # Keys under an unknown top-level prefix only show up in the root listing
+    return ('', None, None)
+
+#def function for refreshing the prefix trie from a checkpoint, re-listing only changed shards
+def refresh_prefix_trie(bucket_name, checkpoint_file, changed_keys=None, max_workers=MAX_WORKERS, depth=DEFAULT_DEPTH):
     try:
-        prefix_size = defaultdict(int)
-        paginator = s3_client.get_paginator('list_objects_v2')
-        for page in paginator.paginate(Bucket=bucket_name):
-            for obj in page.get('Contents', []):
-                key = obj['Key']
-                size = obj['Size']
-                prefix = key.split('/')[0] if '/' in key else key
-                prefix_size[prefix] += size
-        return dict(prefix_size)  # Convert defaultdict to dict before returning
+        conn = open_checkpoint(checkpoint_file)
+        meta = conn.execute("SELECT bucket, depth FROM meta").fetchone()
+        shards = {(prefix, start_after, end_at): shard_id for shard_id, prefix, start_after, end_at
+                  in conn.execute("SELECT id, prefix, start_after, end_at FROM shards")}
+        full_scan = meta != (bucket_name, depth) or changed_keys is None or not shards
+        if full_scan:
+            conn.execute("DELETE FROM meta")
+            conn.execute("DELETE FROM shards")
+            conn.execute("DELETE FROM shard_rows")
+            conn.execute("INSERT INTO meta VALUES (?, ?)", (bucket_name, depth))
+            shards = {}
+            dirty = [('', None, None)]
+        else:
+            shard_index = {}
+            for shard in shards:
+                shard_index.setdefault(shard[0], []).append(shard)
+            dirty = list({owning_shard(shard_index, key) for key in changed_keys})
+
+        listed = 0
+        changed = 0
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while dirty:
+                new_prefixes = []
+                for shard, (shard_trie, digest, prefixes) in zip(dirty, executor.map(lambda s: scan_checkpoint_shard(bucket_name, s, depth), dirty)):
+                    listed += 1
+                    if prefixes is not None:
+                        known = {s[0] for s in shards}
+                        new_prefixes = [prefix for prefix in prefixes if prefix not in known]
+                    shard_id = shards.get(shard)
+                    if shard_id is None:
+                        shard_id = shards[shard] = conn.execute(
+                            "INSERT INTO shards (prefix, start_after, end_at) VALUES (?, ?, ?)", shard).lastrowid
+                    elif conn.execute("SELECT digest FROM shards WHERE id = ?", (shard_id,)).fetchone()[0] == digest:
+                        continue
+                    changed += 1
+                    conn.execute("UPDATE shards SET digest = ? WHERE id = ?", (digest, shard_id))
+                    conn.execute("DELETE FROM shard_rows WHERE shard_id = ?", (shard_id,))
+                    conn.executemany("INSERT INTO shard_rows VALUES (?, ?, ?, ?)",
+                                     ((shard_id, path, size, count) for path, size, count in shard_trie.rows(depth)))
+                dirty = [shard for shard_list in executor.map(lambda p: plan_shards(bucket_name, p), new_prefixes)
+                         for shard in shard_list]
+        conn.commit()
+        print(f"Listed {listed} of {len(shards)} shards, {changed} changed")
+
+        trie = PrefixTrie(depth)
+        for path, size, count in conn.execute("SELECT path, size, count FROM shard_rows"):
+            trie.add(path, size, count)
+        conn.close()
+        return trie
     except ClientError as e:
         print(f"API Error Occurred: {e}")
-        return {}  # Return an empty dictionary on API error
+        return None
     except Exception as e:
         print(f"Error Occurred: {e}")
-        return {}  # Return an empty dictionary on other errors
+        return None
+
+#def function for splitting an s3://bucket/key URI
+def split_s3_uri(uri):
+    bucket, _, key = uri[len('s3://'):].partition('/')
+    return bucket, key
+
+#def function for loading an S3 Inventory manifest from a local path or S3 URI
+def load_inventory_manifest(manifest_path):
+    if manifest_path.startswith('s3://'):
+        bucket, key = split_s3_uri(manifest_path)
+        return json.load(s3_client.get_object(Bucket=bucket, Key=key)['Body'])
+    with open(manifest_path) as file:
+        return json.load(file)
+
+#def function for listing the data files named in an inventory manifest
+def inventory_data_files(manifest):
+    destination_bucket = manifest['destinationBucket'].split(':::')[-1]
+    return [f"s3://{destination_bucket}/{data_file['key']}" for data_file in manifest['files']]
+
+#per-process S3 client and filesystem used by the inventory workers
+worker_clients = {}
+
+#def function for initializing an inventory worker; botocore clients and their connection pools are not fork-safe,
+#so a worker never reuses the ones inherited from the parent
+def init_inventory_worker():
+    worker_clients.clear()
+
+#def function for getting a client of the current process, created on first use
+def worker_client(name, factory):
+    if name not in worker_clients:
+        worker_clients[name] = factory()
+    return worker_clients[name]
+
+#def function for aggregating one inventory data file, streamed a chunk at a time
+def aggregate_inventory_file(path, file_format, file_schema, depth=DEFAULT_DEPTH):
+    trie = PrefixTrie(depth)
+    if file_format == 'Parquet':
+        import pyarrow.parquet as pq
+        if path.startswith('s3://'):
+            from pyarrow import fs
+            source = worker_client('s3_filesystem', fs.S3FileSystem).open_input_file(path[len('s3://'):])
+        else:
+            source = path
+        parquet_file = pq.ParquetFile(source)
+        columns = [c for c in ('key', 'size', 'is_latest', 'is_delete_marker') if c in parquet_file.schema_arrow.names]
+        for batch in parquet_file.iter_batches(batch_size=PARQUET_BATCH_SIZE, columns=columns):
+            batch = batch.to_pydict()
+            is_latest = batch.get('is_latest') or [True] * len(batch['key'])
+            is_delete_marker = batch.get('is_delete_marker') or [False] * len(batch['key'])
+            for key, size, latest, delete_marker in zip(batch['key'], batch['size'], is_latest, is_delete_marker):
+                if latest is not False and not delete_marker:
+                    trie.add(key, size or 0)
+        return trie
+
+    # CSV inventory files are gzipped, headerless and URL-encode the object key
+    columns = [c.strip() for c in file_schema.split(',')]
+    key_col, size_col = columns.index('Key'), columns.index('Size')
+    latest_col = columns.index('IsLatest') if 'IsLatest' in columns else None
+    delete_marker_col = columns.index('IsDeleteMarker') if 'IsDeleteMarker' in columns else None
+    if path.startswith('s3://'):
+        bucket, key = split_s3_uri(path)
+        raw = worker_client('s3', lambda: boto3.client('s3')).get_object(Bucket=bucket, Key=key)['Body']
+    else:
+        raw = open(path, 'rb')
+    with raw, io.TextIOWrapper(gzip.GzipFile(fileobj=raw) if path.endswith('.gz') else raw, newline='') as file:
+        for row in csv.reader(file):
+            if latest_col is not None and row[latest_col] == 'false':
+                continue
+            if delete_marker_col is not None and row[delete_marker_col] == 'true':
+                continue
+            trie.add(unquote_plus(row[key_col]), int(row[size_col] or 0))
+    return trie
+
+#def function for calculating the prefix trie from an S3 Inventory report instead of listing the bucket
+def calculate_prefix_trie_from_inventory(manifest_path, data_files=None, depth=DEFAULT_DEPTH, max_workers=None):
+    try:
+        manifest = load_inventory_manifest(manifest_path)
+        data_files = data_files or inventory_data_files(manifest)
+        file_format = manifest.get('fileFormat', 'CSV')
+        if file_format not in ('CSV', 'Parquet'):
+            print(f"Unsupported inventory format: {file_format}")
+            return None
+        trie = PrefixTrie(depth)
+        with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count(), initializer=init_inventory_worker) as executor:
+            futures = [executor.submit(aggregate_inventory_file, path, file_format, manifest.get('fileSchema', ''), depth)
+                       for path in data_files]
+            for future in futures:
+                trie.merge(future.result())
+        return trie
+    except ClientError as e:
+        print(f"API Error Occurred: {e}")
+        return None
+    except Exception as e:
+        print(f"Error Occurred: {e}")
+        return None
 
 #def write function for writing into csv file
-def write_csv(prefix_size, output_file):
+def write_csv(prefix_size, output_file, level=1):
     with open(output_file, mode='w', newline='') as file:
         writer = csv.writer(file)
+        if isinstance(prefix_size, PrefixTrie):
+            writer.writerow(['Prefix', 'Size(bytes)', 'Objects'])
+            writer.writerows(prefix_size.rows(level))
+            return
         writer.writerow(['Prefix', 'Size(bytes)'])
         for prefix, size in prefix_size.items():
             writer.writerow([prefix, size])
 
+#def function for writing the prefix sizes in the requested output format
+def write_output(prefix_size, output_file, level=1, output_format='csv'):
+    if output_format == 'csv':
+        write_csv(prefix_size, output_file, level)
+        return
+    if isinstance(prefix_size, PrefixTrie):
+        columns = [('Prefix', 'string'), ('Size(bytes)', 'int64'), ('Objects', 'int64')]
+        rows = prefix_size.rows(level)
+    else:
+        columns = [('Prefix', 'string'), ('Size(bytes)', 'int64')]
+        rows = prefix_size.items()
+    with open_writer(output_file, columns, output_format) as writer:
+        writer.write_rows(rows)
+
 #def main function
 def main():
-    bucket_name = input("Enter the bucket name:").strip()
-    output_file = 'prefix_sizes.csv'
-    print(f"Calculating the prefix size of Bucket: {bucket_name}")
-    prefix_size = calculate_prefix_size(bucket_name)
-    if prefix_size:
-        print(f"Writing the prefix size into CSV file: {output_file}")
-        write_csv(prefix_size, output_file)
-        print("CSV is written successfully.")
+    parser = argparse.ArgumentParser(description="Calculate the size of each prefix in an S3 bucket")
+    parser.add_argument('bucket', nargs='?', help="Bucket name (prompted for when omitted)")
+    parser.add_argument('--depth', type=int, default=DEFAULT_DEPTH, help="Number of prefix levels to aggregate")
+    parser.add_argument('--level', type=int, help="Prefix level written to the CSV (defaults to --depth)")
+    parser.add_argument('--output', default='prefix_sizes.csv', help="Path of the output file")
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default='csv', help="Output format")
+    parser.add_argument('--checkpoint', help="Checkpoint file enabling incremental refresh; without --events-queue every run falls back to a full scan")
+    parser.add_argument('--events-queue', help="SQS queue URL receiving the bucket's S3 event notifications")
+    parser.add_argument('--inventory', help="S3 Inventory manifest.json (local path or s3:// URI) used instead of listing")
+    parser.add_argument('--inventory-files', nargs='+', help="Inventory data files (local paths or s3:// URIs) overriding the manifest's list")
+    args = parser.parse_args()
+
+    output_file = args.output
+    level = min(args.level or args.depth, args.depth)
+    if args.inventory:
+        print(f"Calculating the prefix size from S3 Inventory: {args.inventory}")
+        prefix_trie = calculate_prefix_trie_from_inventory(args.inventory, args.inventory_files, depth=args.depth)
+    else:
+        bucket_name = args.bucket or input("Enter the bucket name:").strip()
+        print(f"Calculating the prefix size of Bucket: {bucket_name}")
+        if args.checkpoint:
+            changed_keys, receipt_handles = drain_change_events(args.events_queue, bucket_name) if args.events_queue else (None, [])
+            prefix_trie = refresh_prefix_trie(bucket_name, args.checkpoint, changed_keys, depth=args.depth)
+            if prefix_trie and receipt_handles:
+                delete_change_events(args.events_queue, receipt_handles)
+        else:
+            prefix_trie = calculate_prefix_trie(bucket_name, depth=args.depth)
+    if prefix_trie and prefix_trie.count:
+        print(f"Writing the prefix size into {args.format} file: {output_file}")
+        write_output(prefix_trie, output_file, level, args.format)
+        print("Output is written successfully.")
     else:
         print("No data to write.")
 
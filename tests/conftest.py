@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The scripts create their AWS clients at import time; the tests never reach AWS
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,61 @@
+import itertools
+import math
+import random
+
+import pytest
+
+import cost_aware_auto_scaling as scaling
+
+
+def random_case(rng, weighted):
+    zones = [f"us-east-1{letter}" for letter in 'abcdef'[:rng.randint(1, 6)]]
+    counts = {zone: rng.randint(0, 20) for zone in zones if rng.random() < 0.8}
+    weights = {zone: rng.randint(0, 5) for zone in zones} if weighted else None
+    return counts, zones, weights
+
+
+def quotas(plan, weights):
+    zones = list(plan['Target'])
+    total = sum(plan['Current'].values())
+    weights = {zone: weights.get(zone, 0) for zone in zones} if weights else dict.fromkeys(zones, 1)
+    if not sum(weights.values()):
+        weights = dict.fromkeys(zones, 1)
+    return {zone: total * weights[zone] / sum(weights.values()) for zone in zones}
+
+
+def brute_force_minimum_moves(plan, weights):
+    # Fewest moves over every target that rounds each AZ's quota down or up and keeps the total
+    quota = quotas(plan, weights)
+    zones = list(quota)
+    total = sum(plan['Current'].values())
+    best = None
+    for target in itertools.product(*({math.floor(quota[zone]), math.ceil(quota[zone])} for zone in zones)):
+        if sum(target) != total:
+            continue
+        moves = sum(max(plan['Current'][zone] - count, 0) for zone, count in zip(zones, target))
+        best = moves if best is None else min(best, moves)
+    return best
+
+
+@pytest.mark.parametrize('weighted', [False, True])
+def test_plan_is_balanced_and_minimal(weighted):
+    rng = random.Random(weighted)
+    for _ in range(1000):
+        counts, zones, weights = random_case(rng, weighted)
+        plan = scaling.plan_az_rebalance(counts, zones, weights)
+        current, target = plan['Current'], plan['Target']
+
+        assert sum(target.values()) == sum(counts.values())
+        quota = quotas(plan, weights)
+        assert all(math.floor(quota[zone]) <= target[zone] <= math.ceil(quota[zone]) for zone in target)
+        if not weighted:
+            assert max(target.values()) - min(target.values()) <= 1
+
+        after = dict(current)
+        for move in plan['Moves']:
+            assert move['Count'] > 0 and move['From'] != move['To']
+            after[move['From']] -= move['Count']
+            after[move['To']] += move['Count']
+        assert after == target
+
+        assert sum(move['Count'] for move in plan['Moves']) == brute_force_minimum_moves(plan, weights)
@@ -0,0 +1,108 @@
+import bisect
+import json
+import random
+
+import s3_bucket_size_update as updater
+
+BUCKET = 'example-bucket'
+QUEUE_URL = 'https://sqs.us-east-1.amazonaws.com/123456789012/example-bucket-events'
+
+
+class FakeS3:
+    # list_objects_v2 over an in-memory bucket, counting every LIST call
+    def __init__(self, objects):
+        self.objects = objects
+        self.list_calls = 0
+
+    def list_objects_v2(self, Bucket, Prefix='', Delimiter=None, StartAfter='', MaxKeys=1000, ContinuationToken=None):
+        self.list_calls += 1
+        keys = sorted(self.objects)
+        position = bisect.bisect_right(keys, max(StartAfter or '', ContinuationToken or '', Prefix))
+        position = max(position, bisect.bisect_left(keys, Prefix))
+        contents, common_prefixes, last_key = [], [], None
+        for key in keys[position:]:
+            if not key.startswith(Prefix):
+                break
+            if len(contents) + len(common_prefixes) == MaxKeys:
+                return self.page(contents, common_prefixes, last_key)
+            rest = key[len(Prefix):]
+            if Delimiter and Delimiter in rest:
+                common_prefix = Prefix + rest[:rest.index(Delimiter) + 1]
+                if not common_prefixes or common_prefixes[-1] != common_prefix:
+                    common_prefixes.append(common_prefix)
+            else:
+                contents.append({'Key': key, 'Size': self.objects[key][0], 'ETag': self.objects[key][1]})
+            last_key = key
+        return self.page(contents, common_prefixes, None)
+
+    @staticmethod
+    def page(contents, common_prefixes, next_token):
+        page = {'Contents': contents, 'CommonPrefixes': [{'Prefix': p} for p in common_prefixes], 'IsTruncated': bool(next_token)}
+        if next_token:
+            page['NextContinuationToken'] = next_token
+        return page
+
+    def get_paginator(self, operation):
+        return self
+
+    def paginate(self, **params):
+        while True:
+            page = self.list_objects_v2(**params)
+            yield page
+            if not page['IsTruncated']:
+                return
+            params['ContinuationToken'] = page['NextContinuationToken']
+
+
+class FakeSQS:
+    def __init__(self, keys):
+        self.messages = [{'ReceiptHandle': f"handle-{n}", 'Body': json.dumps({'Records': [
+            {'s3': {'bucket': {'name': BUCKET}, 'object': {'key': key}}}]})} for n, key in enumerate(keys)]
+        self.deleted = 0
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages, WaitTimeSeconds):
+        batch, self.messages = self.messages[:MaxNumberOfMessages], self.messages[MaxNumberOfMessages:]
+        return {'Messages': batch}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        self.deleted += len(Entries)
+
+
+def object_count(trie):
+    return sum(count for _, _, count in trie.rows(1))
+
+
+def test_one_percent_churn_lists_fewer_keys_than_a_full_scan(tmp_path, monkeypatch):
+    rng = random.Random(0)
+    objects = {f"{prefix}/{day:03d}/{n:04d}.log": (rng.randint(1, 10_000), f"etag-{n}")
+               for prefix in ('logs', 'images', 'backups', 'exports') for day in range(10) for n in range(500)}
+    objects.update({f"root-{n}.txt": (n, f"etag-{n}") for n in range(5)})
+    s3 = FakeS3(objects)
+    monkeypatch.setattr(updater, 's3_client', s3)
+    checkpoint = str(tmp_path / 'checkpoint.db')
+    assert object_count(updater.refresh_prefix_trie(BUCKET, checkpoint)) == len(objects)
+
+    # 1% churn, landing where nightly writes do: the newest day of logs is rewritten and appended to
+    changed = [key for key in sorted(objects) if key.startswith('logs/009/')][:len(objects) // 200]
+    for key in changed:
+        objects[key] = (objects[key][0] + 1, 'etag-rewritten')
+    added = [f"logs/010/{n:04d}.log" for n in range(len(objects) // 100 - len(changed))]
+    objects.update({key: (100, 'etag-new') for key in added})
+    sqs = FakeSQS(changed + added)
+    monkeypatch.setattr(updater, 'sqs_client', sqs)
+
+    s3.list_calls = 0
+    changed_keys, receipt_handles = updater.drain_change_events(QUEUE_URL, BUCKET)
+    refreshed = updater.refresh_prefix_trie(BUCKET, checkpoint, changed_keys)
+    updater.delete_change_events(QUEUE_URL, receipt_handles)
+    incremental_calls = s3.list_calls
+
+    s3.list_calls = 0
+    full = updater.calculate_prefix_trie(BUCKET)
+    full_calls = s3.list_calls
+
+    print(f"incremental refresh: {incremental_calls} LIST calls, full scan: {full_calls} LIST calls")
+    assert sorted(refreshed.rows(2)) == sorted(full.rows(2))
+    assert object_count(refreshed) == len(objects)
+    assert sqs.deleted == len(changed) + len(added)
+    assert incremental_calls < full_calls
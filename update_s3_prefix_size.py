@@ -1,48 +1,139 @@
 #import section
+import argparse
 import csv
 from collections import defaultdict
+from itertools import groupby
+from prefix_size_writers import OUTPUT_FORMATS, open_writer
 
-# Function to read the CSV file and calculate prefix sizes
-def process_csv(input_file, output_file):
-    prefix_sizes = defaultdict(int)
-    rows = []
+#define constants
+OUTPUT_COLUMNS = [('Serial Number', 'int64'), ('Prefix', 'string'), ('Size', 'int64'), ('Total Size', 'int64')]
+COMBINE_EVERY = 64  # Partial group-by results merged after this many batches
 
-    # Read the CSV file and calculate the total size for each prefix
-    with open(input_file, mode='r') as file:
+# Function to stream the valid (prefix, size) rows of the CSV file
+def read_rows(input_file, report=True):
+    with open(input_file, mode='r', newline='') as file:
         reader = csv.reader(file)
-        header = next(reader)  # Skip header
+        next(reader, None)  # Skip header
         for row in reader:
             if len(row) < 2:  # Skip rows with fewer than 2 columns
-                print(f"Skipping invalid row: {row}")
+                if report:
+                    print(f"Skipping invalid row: {row}")
                 continue
-            prefix = row[0]
             try:
                 size = int(row[1])
             except ValueError:
-                print(f"Skipping row with invalid size value: {row}")
+                if report:
+                    print(f"Skipping row with invalid size value: {row}")
                 continue
-            prefix_sizes[prefix] += size
-            rows.append(row)
+            yield row[0], size
+
+# Function to check whether the rows are grouped by prefix in sorted order
+def is_sorted_by_prefix(input_file):
+    previous = None
+    for prefix, _ in read_rows(input_file, report=False):
+        if previous is not None and prefix < previous:
+            return False
+        previous = prefix
+    return True
+
+# Function to yield (prefix, size, total size) for unsorted input, holding one total per distinct prefix
+def rows_with_totals(input_file):
+    prefix_sizes = defaultdict(int)
+    for prefix, size in read_rows(input_file):
+        prefix_sizes[prefix] += size
+    for prefix, size in read_rows(input_file, report=False):
+        yield prefix, size, prefix_sizes[prefix]
+
+# Function to yield (prefix, size, total size) for sorted input in constant memory
+def sorted_rows_with_totals(input_file):
+    # A leading reader totals each prefix group, then a trailing reader replays the group's rows
+    trailing = read_rows(input_file, report=False)
+    for prefix, group in groupby(read_rows(input_file), key=lambda row: row[0]):
+        count = 0
+        total_size = 0
+        for _, size in group:
+            count += 1
+            total_size += size
+        for _ in range(count):
+            _, size = next(trailing)
+            yield prefix, size, total_size
+
+# Function to stream (prefix, size) record batches of the CSV file, dropping invalid rows
+def read_batches(input_file):
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    from pyarrow import csv as pa_csv
+
+    options = pa_csv.ConvertOptions(column_types={'Prefix': pa.string(), 'Size(bytes)': pa.string()},
+                                    include_columns=['Prefix', 'Size(bytes)'])
+    parse_options = pa_csv.ParseOptions(invalid_row_handler=lambda row: 'skip')
+    for batch in pa_csv.open_csv(input_file, parse_options=parse_options, convert_options=options):
+        prefix, size = batch.column(0), batch.column(1)
+        valid = pc.and_kleene(pc.is_valid(prefix), pc.match_substring_regex(size, r'^\s*-?\d+\s*$'))
+        yield pa.table({'Prefix': pc.filter(prefix, valid),
+                        'Size': pc.cast(pc.utf8_trim_whitespace(pc.filter(size, valid)), pa.int64())})
+
+# Function to sum sizes by prefix with a vectorized group-by
+def group_sizes(table):
+    return table.group_by('Prefix').aggregate([('Size', 'sum')]).select(['Prefix', 'Size_sum']).rename_columns(['Prefix', 'Size'])
+
+# Function to write the output in columnar form with a vectorized group-by for the total size column
+def process_csv_columnar(input_file, output_file, output_format):
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    # First pass: group-by sum per batch, merging the partial results periodically
+    partials = []
+    for table in read_batches(input_file):
+        partials.append(group_sizes(table))
+        if len(partials) >= COMBINE_EVERY:
+            partials = [group_sizes(pa.concat_tables(partials))]
+    if partials:
+        totals = group_sizes(pa.concat_tables(partials))
+    else:
+        totals = pa.table({'Prefix': pa.array([], pa.string()), 'Size': pa.array([], pa.int64())})
+    total_prefix, total_size = totals.column('Prefix').combine_chunks(), totals.column('Size').combine_chunks()
+
+    # Second pass: look up each batch's totals by index and write it out
+    schema = pa.schema([(name, getattr(pa, type_name)()) for name, type_name in OUTPUT_COLUMNS])
+    serial_number = 1
+    with open_writer(output_file, OUTPUT_COLUMNS, output_format) as writer:
+        for table in read_batches(input_file):
+            count = table.num_rows
+            batch = pa.record_batch([
+                pa.array(range(serial_number, serial_number + count), pa.int64()),
+                table.column('Prefix').combine_chunks(),
+                table.column('Size').combine_chunks(),
+                pc.take(total_size, pc.index_in(table.column('Prefix').combine_chunks(), value_set=total_prefix)),
+            ], schema=schema)
+            writer.write_batch(batch)
+            serial_number += count
+
+# Function to read the CSV file and calculate prefix sizes
+def process_csv(input_file, output_file, sorted_input=None, output_format='csv'):
+    if output_format != 'csv':
+        process_csv_columnar(input_file, output_file, output_format)
+        return
+    if sorted_input is None:
+        sorted_input = is_sorted_by_prefix(input_file)
+    rows = sorted_rows_with_totals(input_file) if sorted_input else rows_with_totals(input_file)
 
     # Update serial numbers and add the total size column
-    with open(output_file, mode='w', newline='') as file:
-        writer = csv.writer(file)
-        writer.writerow(['Serial Number', 'Prefix', 'Size', 'Total Size'])
-        for index, row in enumerate(rows):
-            serial_number = index + 1
-            prefix = row[0]
-            size = row[1]
-            total_size = prefix_sizes[prefix]
-            writer.writerow([serial_number, prefix, size, total_size])
+    with open_writer(output_file, OUTPUT_COLUMNS) as writer:
+        writer.write_rows((serial_number, prefix, size, total_size)
+                          for serial_number, (prefix, size, total_size) in enumerate(rows, start=1))
 
 # Main function
 def main():
-    input_file = 'prefix_sizes.csv'
-    output_file = 'output.csv'
+    parser = argparse.ArgumentParser(description="Add serial numbers and per-prefix totals to a prefix size CSV")
+    parser.add_argument('--input', default='prefix_sizes.csv', help="Path of the input CSV file")
+    parser.add_argument('--output', default='output.csv', help="Path of the output file")
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default='csv', help="Output format")
+    args = parser.parse_args()
 
-    print(f"Processing CSV file: {input_file}")
-    process_csv(input_file, output_file)
-    print(f"Updated CSV file written to: {output_file}")
+    print(f"Processing CSV file: {args.input}")
+    process_csv(args.input, args.output, output_format=args.format)
+    print(f"Updated CSV file written to: {args.output}")
 
 if __name__ == '__main__':
     main()